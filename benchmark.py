@@ -0,0 +1,271 @@
+'''Benchmark harness for the solvers, propagators and Tenner models.
+
+   Runs a fixed corpus of problems, each with every propagator
+   (prop_BT, prop_FC, prop_GAC), and records for each run the model
+   build time, the solve time, the search statistics and the peak
+   memory used. The corpus is
+
+      - the sample Tenner boards b1, b2, b3 with tenner_csp_model_1 and
+        tenner_csp_model_2
+      - generated Tenner boards with 3 to 8 rows (see generate_tenner_board;
+        the boards are generated from fixed seeds, so they are the same
+        on every run) with both models
+      - n-Queens (nQueens of csp_sample_run) at growing n
+
+   Table constraints share their relations through cspbase.relations
+   (see RelationCache). The cache is cleared before each timed build
+   and before the memory run, so buildTime and peakMemory include 
+   building the tables; warmBuildTime is the time of a second build
+   right after, with the tables cached.
+
+   Every run looks for one solution and is stopped after a budget of
+   decisions (status 'budget' in the results), so hopeless combinations
+   (e.g., prop_BT on a Tenner board) cost a bounded amount of time and
+   the node counts stay reproducible.
+
+   The results can be saved as a JSON baseline and a later run compared
+   against it. Changed node counts or outcomes are reported as changes
+   (the search is deterministic, so they mean the search itself
+   changed); build and solve times and memory more than the tolerance
+   above the baseline are reported as regressions. E.g.,
+
+      python benchmark.py --save baseline.json
+      ... change the code ...
+      python benchmark.py --compare baseline.json
+
+   exits with status 1 if there are regressions or changes.
+'''
+
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from cspbase import *
+from propagators import *
+from tenner_csp import tenner_csp_model_1, tenner_csp_model_2
+from tenner_sample_run import b1, b2, b3
+from csp_sample_run import nQueens
+
+PROPAGATORS = [('BT', prop_BT), ('FC', prop_FC), ('GAC', prop_GAC)]
+MODELS = [('model_1', tenner_csp_model_1), ('model_2', tenner_csp_model_2)]
+
+def generate_tenner_board(rows, seed, given=0.5):
+    '''Return a Tenner board (n_grid, last_row) with rows rows that has
+       a solution: a random filled grid is generated (with random.Random
+       (seed)), its column sums computed, and each cell kept as a pre-set
+       value with probability given (the rest are -1)'''
+    rng = random.Random(seed)
+    grid = []
+    while len(grid) < rows:
+        row = fill_tenner_row(grid[-1] if grid else None, rng)
+        if row is None:
+            grid = []   #dead end, start over
+        else:
+            grid.append(row)
+    sums = [sum(row[col] for row in grid) for col in range(10)]
+    board = [[val if rng.random() < given else -1 for val in row] for row in grid]
+    return board, sums
+
+def fill_tenner_row(above, rng):
+    '''Return a random permutation of 0..9 whose cells all differ from
+       the (up to three) touching cells of the row above, or None'''
+    row = []
+    used = set()
+    options = []    #untried values for each cell placed so far
+    while len(row) < 10:
+        col = len(row)
+        if len(options) == col:
+            vals = [v for v in range(10) if not v in used]
+            if above is not None:
+                vals = [v for v in vals if not v in above[max(0, col - 1):col + 2]]
+            rng.shuffle(vals)
+            options.append(vals)
+        if options[col]:
+            val = options[col].pop()
+            row.append(val)
+            used.add(val)
+        else:
+            options.pop()
+            if not row:
+                return None
+            used.discard(row.pop())
+    return row
+
+def corpus(quick=False):
+    '''Return the benchmark cases as a list of (name, factory, args)'''
+    cases = []
+    for name, board in (('b1', b1), ('b2', b2), ('b3', b3)):
+        for model, factory in MODELS:
+            cases.append(('tenner-{}-{}'.format(name, model), factory, (board,)))
+    rowCounts = (3, 5, 8) if quick else range(3, 9)
+    for rows in rowCounts:
+        board = generate_tenner_board(rows, seed=rows)
+        for model, factory in MODELS:
+            cases.append(('tenner-gen{}-{}'.format(rows, model), factory, (board,)))
+    sizes = (4, 8, 12) if quick else (4, 6, 8, 10, 12, 14, 16)
+    for n in sizes:
+        cases.append(('queens-{}'.format(n), nQueens, (n,)))
+    return cases
+
+def build(factory, args, warm=False):
+    '''Build the case's CSP, return (csp, CPU seconds taken). Unless warm
+       is True the relation cache is cleared first, so the tables are 
+       built too.'''
+    if not warm:
+        relations.clear()
+    start = time.process_time()
+    csp = factory(*args)
+    if isinstance(csp, tuple):
+        csp = csp[0]
+    return csp, time.process_time() - start
+
+def solve(csp, propagator, budget):
+    '''Search for one solution with at most budget decisions (after the
+       first budget decisions the search stops at its next decision).
+       Return (status, metrics): status is 'solved', 'unsat' or 'budget'
+       and metrics the SearchMetrics of the search.'''
+    solver = BT(csp)
+    status, stime = solver.start_search(propagator, report=False)
+    outcome = 'unsat'
+    if status:
+        search = solver.iter_search(solver.propagator, nodeLimit=budget)
+        for event in search:
+            outcome = 'solved' if event == 'solution' else 'budget'
+            break
+        search.close()
+    solver.end_search(stime, outcome == 'solved')
+    solver.unassign_all()
+    return outcome, solver.metrics
+
+def run_case(name, factory, args, propName, propagator, budget, repeat=1,
+             memory=True):
+    '''Run one case with one propagator and return its results as a dict.
+       Times are the minimum over repeat runs. Memory (peak bytes
+       allocated while building and solving, measured by tracemalloc)
+       is measured in a separate run, as tracing slows everything down.'''
+    buildTime = warmBuildTime = solveTime = None
+    for i in range(repeat):
+        secs = build(factory, args)[1]
+        csp, warmSecs = build(factory, args, warm=True)
+        outcome, metrics = solve(csp, propagator, budget)
+        if buildTime is None or secs < buildTime:
+            buildTime = secs
+        if warmBuildTime is None or warmSecs < warmBuildTime:
+            warmBuildTime = warmSecs
+        if solveTime is None or metrics.runtime < solveTime:
+            solveTime = metrics.runtime
+
+    peakMemory = None
+    if memory:
+        tracemalloc.start()
+        try:
+            csp, secs = build(factory, args)
+            solve(csp, propagator, budget)
+            peakMemory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {'case': name, 'propagator': propName, 'status': outcome,
+            'buildTime': buildTime, 'warmBuildTime': warmBuildTime,
+            'solveTime': solveTime,
+            'nodes': metrics.nodes, 'failures': metrics.failures,
+            'prunings': metrics.prunings, 'peakMemory': peakMemory}
+
+def run_benchmarks(cases, budget, repeat=1, memory=True, propagators=PROPAGATORS,
+                   log=None):
+    '''Run every case with every propagator, return the list of results'''
+    results = []
+    for name, factory, args in cases:
+        for propName, propagator in propagators:
+            result = run_case(name, factory, args, propName, propagator, budget,
+                              repeat, memory)
+            results.append(result)
+            if log is not None:
+                print(format_result(result), file=log, flush=True)
+    return results
+
+def format_result(r):
+    memory = '-' if r['peakMemory'] is None else '{:.1f}MB'.format(r['peakMemory'] / 1e6)
+    return '{:<24} {:<4} {:<7} build {:7.3f}s (warm {:.3f}s)  solve {:8.3f}s  nodes {:>7}  mem {}'.format(
+        r['case'], r['propagator'], r['status'], r['buildTime'], r['warmBuildTime'],
+        r['solveTime'], r['nodes'], memory)
+
+def compare(results, baseline, tolerance=0.25, minTime=0.05):
+    '''Compare results with the baseline results. Return a list of
+       messages, one per change or regression: a different outcome or
+       node count, or a time (memory) more than tolerance (a fraction)
+       above the baseline's. Times below minTime seconds are too noisy
+       to compare.'''
+    old = dict(((r['case'], r['propagator']), r) for r in baseline)
+    problems = []
+    for r in results:
+        key = (r['case'], r['propagator'])
+        b = old.get(key)
+        if b is None:
+            continue
+        label = '{} {}'.format(*key)
+        if r['status'] != b['status'] or r['nodes'] != b['nodes']:
+            problems.append('CHANGED {}: {} with {} nodes, was {} with {} nodes'.format(
+                label, r['status'], r['nodes'], b['status'], b['nodes']))
+        for field in ('buildTime', 'warmBuildTime', 'solveTime'):
+            if b.get(field) is None:
+                continue    #baseline saved before the field existed
+            if max(r[field], b[field]) < minTime:
+                continue
+            if r[field] > b[field] * (1 + tolerance):
+                problems.append('SLOWER {}: {} {:.3f}s, was {:.3f}s'.format(
+                    label, field, r[field], b[field]))
+        if r['peakMemory'] is not None and b.get('peakMemory') is not None:
+            if r['peakMemory'] > b['peakMemory'] * (1 + tolerance):
+                problems.append('MEMORY {}: {:.1f}MB, was {:.1f}MB'.format(
+                    label, r['peakMemory'] / 1e6, b['peakMemory'] / 1e6))
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the solver benchmarks')
+    parser.add_argument('--quick', action='store_true',
+                        help='smaller corpus')
+    parser.add_argument('--budget', type=int, default=20000,
+                        help='decisions allowed per run (default 20000)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='take the best time of this many runs')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='do not measure memory')
+    parser.add_argument('--propagators', default='BT,FC,GAC',
+                        help='comma separated subset of BT,FC,GAC')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with the results saved in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown as a fraction (default 0.25)')
+    opts = parser.parse_args(argv)
+
+    names = opts.propagators.split(',')
+    propagators = [(n, p) for n, p in PROPAGATORS if n in names]
+    results = run_benchmarks(corpus(opts.quick), opts.budget, opts.repeat,
+                             not opts.no_memory, propagators, log=sys.stdout)
+
+    if opts.save:
+        with open(opts.save, 'w') as f:
+            json.dump({'budget': opts.budget, 'results': results}, f, indent=1)
+
+    if opts.compare:
+        with open(opts.compare) as f:
+            saved = json.load(f)
+        if saved['budget'] != opts.budget:
+            print("ERROR: baseline was run with a budget of", saved['budget'])
+            return 2
+        problems = compare(results, saved['results'], opts.tolerance)
+        for p in problems:
+            print(p)
+        print("{} regressions or changes against {}".format(len(problems), opts.compare))
+        if problems:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
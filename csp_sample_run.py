@@ -2,11 +2,6 @@ from cspbase import *
 from propagators import *
 import itertools
 
-x = Variable('X', [1, 2, 3])
-y = Variable('Y', [1, 2, 3])
-z = Variable('Z', [1, 2, 3])
-w = Variable('W', [1, 2, 3, 4])
-
 def w_eq_sum_x_y_z(wxyz):
     #note inputs lists of value
     w = wxyz[0]
@@ -15,42 +10,6 @@ def w_eq_sum_x_y_z(wxyz):
     z = wxyz[3]
     return(w == x + y + z)
 
-c1 = Constraint('C1', [x, y, z])
-#c1 is constraint x == y + z. Below are all of the satisfying tuples
-c1.add_satisfying_tuples([[2, 1, 1], [3, 1, 2], [3, 2, 1]])
-
-c2 = Constraint('C2', [w, x, y, z])
-#c2 is constraint w == x + y + z. Instead of writing down the satisfying
-#tuples we compute them
-
-varDoms = []
-for v in [w, x, y, z]:
-    varDoms.append(v.domain())    
-
-sat_tuples = []
-for t in itertools.product(*varDoms):
-    #NOTICE use of * to convert the list v to a sequence of arguments to product
-    if w_eq_sum_x_y_z(t):
-        sat_tuples.append(t)
-
-c2.add_satisfying_tuples(sat_tuples)
-
-simpleCSP = CSP("SimpleEqs", [x,y,z,w])
-simpleCSP.add_constraint(c1)
-simpleCSP.add_constraint(c2)
-
-btracker = BT(simpleCSP)
-#btracker.trace_on()
-
-print("Plain Bactracking on simple CSP")
-btracker.bt_search(prop_BT)
-print("=======================================================")
-print("Forward Checking on simple CSP")
-btracker.bt_search(prop_FC)
-print("=======================================================")
-print("GAC on simple CSP")
-btracker.bt_search(prop_GAC)
-
 #Now n-Queens example
 
 def queensCheck(qi, qj, i, j):
@@ -59,6 +18,11 @@ def queensCheck(qi, qj, i, j):
     '''
     return i != j and abs(i-j) != abs(qi-qj)
 
+def queensRelation(vals, dist):
+    '''Return true if queens dist rows apart can be placed in the columns
+       vals[0] and vals[1]. Used by nQueens as a shared relation.'''
+    return queensCheck(0, dist, vals[0], vals[1])
+
 def nQueens(n):
     '''Return an n-queens CSP'''
     i = 0
@@ -73,12 +37,10 @@ def nQueens(n):
     cons = []    
     for qi in range(len(dom)):
         for qj in range(qi+1, len(dom)):
-            con = Constraint("C(Q{},Q{})".format(qi+1,qj+1),[vars[qi], vars[qj]]) 
-            sat_tuples = []
-            for t in itertools.product(dom, dom):
-                if queensCheck(qi, qj, t[0], t[1]):
-                    sat_tuples.append(t)
-            con.add_satisfying_tuples(sat_tuples)
+            #the table only depends on the distance between the rows, so
+            #it is shared by all the pairs (and boards) at that distance
+            con = table_constraint("C(Q{},Q{})".format(qi+1,qj+1),
+                                   [vars[qi], vars[qj]], queensRelation, qj - qi)
             cons.append(con)
     
     csp = CSP("{}-Queens".format(n), vars)
@@ -98,14 +60,53 @@ def solve_nQueens(n, propType, trace=False):
     elif propType == 'GAC':
         solver.bt_search(prop_GAC)
         
-#trace = True
-trace = False
-print("Plain Bactracking on 8-queens")
-solve_nQueens(8, 'BT', trace)
-print("=======================================================")
-print("Forward Checking 8-queens")
-solve_nQueens(8, 'FC', trace)
-print("=======================================================")
-print("GAC 8-queens")
-solve_nQueens(8, 'GAC', trace)
+if __name__ == "__main__":
+    x = Variable('X', [1, 2, 3])
+    y = Variable('Y', [1, 2, 3])
+    z = Variable('Z', [1, 2, 3])
+    w = Variable('W', [1, 2, 3, 4])
+
+    c1 = Constraint('C1', [x, y, z])
+    #c1 is constraint x == y + z. Below are all of the satisfying tuples
+    c1.add_satisfying_tuples([[2, 1, 1], [3, 1, 2], [3, 2, 1]])
+
+    c2 = Constraint('C2', [w, x, y, z])
+    #c2 is constraint w == x + y + z. Instead of writing down the satisfying
+    #tuples we compute them
+
+    varDoms = []
+    for v in [w, x, y, z]:
+        varDoms.append(v.domain())    
+
+    #NOTICE use of * to convert the list v to a sequence of arguments to product.
+    #The generator is consumed as the tuples are stored, no list is built
+    c2.add_satisfying_tuples(t for t in itertools.product(*varDoms)
+                             if w_eq_sum_x_y_z(t))
+
+    simpleCSP = CSP("SimpleEqs", [x,y,z,w])
+    simpleCSP.add_constraint(c1)
+    simpleCSP.add_constraint(c2)
+
+    btracker = BT(simpleCSP)
+    #btracker.trace_on()
+
+    print("Plain Bactracking on simple CSP")
+    btracker.bt_search(prop_BT)
+    print("=======================================================")
+    print("Forward Checking on simple CSP")
+    btracker.bt_search(prop_FC)
+    print("=======================================================")
+    print("GAC on simple CSP")
+    btracker.bt_search(prop_GAC)
+
+    #trace = True
+    trace = False
+    print("Plain Bactracking on 8-queens")
+    solve_nQueens(8, 'BT', trace)
+    print("=======================================================")
+    print("Forward Checking 8-queens")
+    solve_nQueens(8, 'FC', trace)
+    print("=======================================================")
+    print("GAC 8-queens")
+    solve_nQueens(8, 'GAC', trace)
 
@@ -1,5 +1,16 @@
 import time
 import functools
+import itertools
+import collections
+import random
+import json
+import csv
+import array
+import bisect
+import operator
+import mmap
+import os
+import weakref
 
 '''Constraint Satisfaction Routines
    A) class Variable
@@ -45,8 +56,10 @@ class Variable:
 
        The variable object offers two types of functionality to support
        search. 
-       (a) It has a current domain, implimented as a set of flags 
-           determining which domain values are "current", i.e., unpruned.
+       (a) It has a current domain, implimented as an integer bitmask 
+           (bit i set iff the i'th domain value is "current", i.e., unpruned)
+           along with a count of the current values and a value-->index dict
+           so that pruning, membership and size queries are all O(1).
            - you can prune a value, and restore it.
            - you can obtain a list of values in the current domain, or count
              how many are still there
@@ -72,6 +85,9 @@ class Variable:
            flags are not changed so that pruning and unpruning can
            work independently of assignment and unassignment. 
            '''
+    __slots__ = ('name', 'id', 'owner', 'dom', 'valIndex', 'curdom', 'curdomSize',
+                 'trail', 'listener', 'scopePositions', 'assignedValue')
+
     #
     #set up and info methods
     #
@@ -80,8 +96,17 @@ class Variable:
         string). Optionally specify the initial domain.
         '''
         self.name = name                #text name for variable
-        self.dom = list(domain)         #Make a copy of passed domain
-        self.curdom = [True] * len(domain)      #using list
+        self.id = None                  #position in the CSP's variable list
+        self.owner = None               #weak reference to that CSP
+        self.dom = []                   #permanent domain (list of values)
+        self.valIndex = dict()          #value --> index into dom
+        self.curdom = 0                 #bitmask, bit i set iff dom[i] is current
+        self.curdomSize = 0             #number of bits set in curdom
+        self.trail = None               #Trail prunings are recorded on (see CSP)
+        self.listener = None            #notified of current domain changes
+        self.scopePositions = []        #(constraint, position in its scope) of
+                                        #the constraints over this variable
+        self.add_domain_values(domain)
         #for bt_search
         self.assignedValue = None
 
@@ -89,8 +114,12 @@ class Variable:
         '''Add additional domain values to the domain
            Removals not supported removals'''
         for val in values: 
+            i = len(self.dom)
             self.dom.append(val)
-            self.curdom.append(True)
+            if not val in self.valIndex:
+                self.valIndex[val] = i
+            self.curdom |= (1 << i)
+            self.curdomSize += 1
 
     def domain_size(self):
         '''Return the size of the (permanent) domain'''
@@ -105,47 +134,75 @@ class Variable:
     #
 
     def prune_value(self, value):
-        '''Remove value from CURRENT domain'''
-        self.curdom[self.value_index(value)] = False
+        '''Remove value from CURRENT domain. If the variable is attached
+           to a trail the pruning is recorded there so that it can be
+           undone on backtrack. Pruning a value that is not current
+           is a no-op (and is not recorded).'''
+        i = self.valIndex[value]
+        bit = 1 << i
+        if self.curdom & bit:
+            self.curdom ^= bit
+            self.curdomSize -= 1
+            if self.trail is not None:
+                self.trail.record_pruning(self, i)
+            if self.listener is not None:
+                self.listener.domain_changed(self)
 
     def unprune_value(self, value):
         '''Restore value to CURRENT domain'''
-        self.curdom[self.value_index(value)] = True
+        bit = 1 << self.valIndex[value]
+        if not self.curdom & bit:
+            self.curdom |= bit
+            self.curdomSize += 1
+            if self.listener is not None:
+                self.listener.domain_changed(self)
 
     def cur_domain(self):
         '''return list of values in CURRENT domain (if assigned 
            only assigned value is viewed as being in current domain)'''
-        vals = []
         if self.is_assigned():
-            vals.append(self.get_assigned_value())
-        else:
-            for i, val in enumerate(self.dom):
-                if self.curdom[i]:
-                    vals.append(val)
+            return [self.assignedValue]
+        vals = []
+        bits = self.curdom
+        while bits:
+            low = bits & -bits
+            vals.append(self.dom[low.bit_length() - 1])
+            bits ^= low
         return vals
 
     def in_cur_domain(self, value):
         '''check if value is in CURRENT domain (without constructing list)
            if assigned only assigned value is viewed as being in current 
            domain'''
-        if not value in self.dom:
+        i = self.valIndex.get(value)
+        if i is None:
             return False
-        if self.is_assigned():
-            return value == self.get_assigned_value()
-        else:
-            return self.curdom[self.value_index(value)]
+        if self.assignedValue is not None:
+            return value == self.assignedValue
+        return (self.curdom >> i) & 1 == 1
 
     def cur_domain_size(self):
         '''Return the size of the variables domain (without construcing list)'''
-        if self.is_assigned():
+        if self.assignedValue is not None:
             return 1
-        else:
-            return(sum(1 for v in self.curdom if v))
+        return self.curdomSize
+
+    def trail_undo(self, i):
+        '''Called by the trail on backtrack: put the i'th domain value
+           back into the CURRENT domain'''
+        bit = 1 << i
+        if not self.curdom & bit:
+            self.curdom |= bit
+            self.curdomSize += 1
+            if self.listener is not None:
+                self.listener.domain_changed(self)
 
     def restore_curdom(self):
         '''return all values back into CURRENT domain'''
-        for i in range(len(self.curdom)):
-            self.curdom[i] = True
+        self.curdom = (1 << len(self.dom)) - 1
+        self.curdomSize = len(self.dom)
+        if self.listener is not None:
+            self.listener.domain_changed(self)
 
     #
     #methods for assigning and unassigning
@@ -165,6 +222,11 @@ class Variable:
             return
 
         self.assignedValue = value
+        for c, i in self.scopePositions:
+            c.nUnasgn -= 1
+            c.unasgnXor ^= i
+        if self.listener is not None:
+            self.listener.domain_changed(self)
 
     def unassign(self):
         '''Used by bt_search. Unassign and restore old curdom'''
@@ -172,6 +234,11 @@ class Variable:
             print("ERROR: trying to unassign variable", self, " not yet assigned")
             return
         self.assignedValue = None
+        for c, i in self.scopePositions:
+            c.nUnasgn += 1
+            c.unasgnXor ^= i
+        if self.listener is not None:
+            self.listener.domain_changed(self)
 
     def get_assigned_value(self):
         '''return assigned value...returns None if is unassigned'''
@@ -184,7 +251,7 @@ class Variable:
     def value_index(self, value):
         '''Domain values need not be numbers, so return the index
            in the domain list of a variable value'''
-        return self.dom.index(value)
+        return self.valIndex[value]
 
     def __repr__(self):
         return("Var-{}".format(self.name))
@@ -194,15 +261,415 @@ class Variable:
 
     def print_all(self):
         '''Also print the variable domain and current domain'''
+        curdom = [(self.curdom >> i) & 1 == 1 for i in range(len(self.dom))]
         print("Var--\"{}\": Dom = {}, CurDom = {}".format(self.name, 
                                                              self.dom, 
-                                                             self.curdom))
+                                                             curdom))
+
+def csv_tuples(buf, convert=int):
+    '''Generate the tuples of CSV data, one per non empty line, 
+       converting each value with convert. buf is a memory map or a file
+       opened in binary mode (anything with a readline method returning
+       bytes).'''
+    lines = (line.decode() for line in iter(buf.readline, b''))
+    for row in csv.reader(lines):
+        if row:
+            yield tuple(map(convert, row))
+
+def binary_tuples(buf, typecode, arity, chunk=1 << 14):
+    '''Generate the tuples of arity values packed in a binary buffer
+       (bytes or a memory map), each value a machine value of the array
+       module's typecode. The buffer is converted chunk tuples at a time.'''
+    itemsize = array.array(typecode).itemsize
+    rowBytes = itemsize * arity
+    if rowBytes == 0:
+        return
+    end = len(buf) - len(buf) % rowBytes
+    if end != len(buf):
+        print("ERROR: binary tuple data ends with a partial tuple, ignored")
+    for start in range(0, end, rowBytes * chunk):
+        vals = array.array(typecode)
+        vals.frombytes(buf[start:min(end, start + rowBytes * chunk)])
+        yield from zip(*[vals[i::arity] for i in range(arity)])
+
+@functools.lru_cache(maxsize=1024)
+def scaled_index(domain, mult=1):
+    '''Return a dict mapping each value of domain (a tuple of values) to
+       its index times mult. A value that repeats maps to its first
+       index, as in Variable.valIndex. Used by TupleTable to encode 
+       tuples, and shared by all the tables over the same domains. Do 
+       not modify the dict.'''
+    scaled = dict()
+    for j, val in enumerate(domain):
+        if not val in scaled:
+            scaled[val] = j * mult
+    return scaled
+
+class TupleTable:
+    '''Storage of the satisfying tuples of a table constraint.
+
+       A table is a relation over a list of domains (tuples of values), 
+       one per position, and knows nothing about variables, so tables 
+       over the same domains can be shared by constraints (see 
+       RelationCache). A tuple is stored as the indices of its values in
+       the domains: one row of arity
+       small ints, the rows one after the other in a single array. For
+       the membership test each row is also read as a mixed radix number
+       (radix the domain sizes), its code. The codes are kept as a 
+       bitmap over all possible codes when that is no bigger than 64 
+       bits per row, else as a sorted array searched by bisection (a set
+       if they would not fit in 64 bits). Iterating over the table gives
+       the tuples of values in the order they were first added, and len,
+       in and not work as they did on the dict of tuples it replaces.
+
+       The supports are index arrays into the rows, in compressed sparse
+       row form: slot s = base[i] + j stands for the j'th value of the
+       i'th domain, and the rows with that value are
+       supRows[supStart[s]:supStart[s+1]], in row order. They are built
+       on first use, see build_supports.
+
+       A tuple with a value outside its domain can never be part of a
+       solution and is not stored.
+
+       A shared table must not be changed: Constraint copies it before
+       adding tuples or growing its domains.'''
+
+    __slots__ = ('domains', 'data', 'nRows', 'radix', 'weights', 'bitmap',
+                 'codes', 'base', 'supStart', 'supRows', 'shared', 'tupleSet')
+
+    def __init__(self, domains=()):
+        self.domains = []               #per position: tuple of values
+        self.data = array.array('B')    #the rows, arity entries each
+        self.nRows = 0
+        self.radix = None               #domain sizes the codes are based on
+        self.weights = None             #per position: value --> its code term
+        self.bitmap = None              #bit per possible code, or None
+        self.codes = array.array('q')   #else the codes, sorted (or a set)
+        self.base = None
+        self.supStart = None
+        self.supRows = None
+        self.shared = False             #used by several constraints
+        self.tupleSet = None            #see __contains__
+        self.set_domains(domains)
+
+    def __len__(self):
+        return self.nRows
+
+    def __iter__(self):
+        for r in range(self.nRows):
+            yield self.row(r)
+
+    #tables with at most this many rows also keep their tuples in a set
+    SMALL = 1 << 10
+
+    def __contains__(self, vals):
+        tupleSet = self.tupleSet
+        if tupleSet is not None:
+            #hashing the tuple is cheaper than encoding it (in FC's
+            #checks); the set is built on the first test, small tables only
+            try:
+                return tuple(vals) in tupleSet
+            except TypeError:
+                return False
+        if 0 < self.nRows <= self.SMALL:
+            self.tupleSet = frozenset(self)
+            return self.__contains__(vals)
+        weights = self.weights
+        try:
+            k = len(vals)
+            if k != len(weights):
+                return False
+            #direct mixed radix sum for the common small arities
+            if k == 2:
+                code = weights[0][vals[0]] + weights[1][vals[1]]
+            elif k == 3:
+                code = weights[0][vals[0]] + weights[1][vals[1]] + weights[2][vals[2]]
+            else:
+                code = sum(map(dict.__getitem__, weights, vals))
+        except (KeyError, TypeError):
+            return False    #a value outside its domain (or no tuples yet)
+        bitmap = self.bitmap
+        if bitmap is not None:
+            return (bitmap[code >> 3] >> (code & 7)) & 1 == 1
+        return self.has_code(code)
+
+    def row(self, r):
+        '''Return the r'th tuple (of values)'''
+        k = len(self.domains)
+        data = self.data
+        return tuple(dom[data[r * k + i]] for i, dom in enumerate(self.domains))
+
+    def set_domains(self, domains):
+        '''Make the table a relation over domains (sequences of values),
+           which must extend the current domains: values can be added at
+           the end of a domain, never removed or reordered. The rows are
+           recoded if the domain sizes changed.'''
+        domains = [tuple(dom) for dom in domains]
+        if domains == self.domains:
+            return
+        if self.nRows and (len(domains) != len(self.domains) or
+                           any(new[:len(old)] != old
+                               for old, new in zip(self.domains, domains))):
+            print("ERROR: table domains can only grow, new domains ignored")
+            return
+        self.domains = domains
+        self.base = self.supStart = self.supRows = None
+        self.tupleSet = None
+        self.recode([len(dom) for dom in domains])
+
+    def copy(self):
+        '''Return an unshared copy of the table'''
+        table = TupleTable()
+        table.domains = list(self.domains)
+        table.data = array.array(self.data.typecode, self.data)
+        table.nRows = self.nRows
+        table.radix = self.radix
+        table.weights = self.weights
+        table.bitmap = None if self.bitmap is None else bytearray(self.bitmap)
+        codes = self.codes
+        table.codes = (None if codes is None else set(codes) if isinstance(codes, set)
+                       else array.array('q', codes))
+        return table
+
+    def has_code(self, code):
+        bitmap = self.bitmap
+        if bitmap is not None:
+            return (bitmap[code >> 3] >> (code & 7)) & 1 == 1
+        codes = self.codes
+        if isinstance(codes, set):
+            return code in codes
+        i = bisect.bisect_left(codes, code)
+        return i < len(codes) and codes[i] == code
+
+    def add(self, tuples):
+        '''Add the tuples (of values) not already in the table. tuples
+           can be any iterable of sequences of values (e.g., a generator)
+           or a 2 dimensional NumPy array with one row per tuple. It is
+           consumed CHUNK tuples at a time, so a list of all the tuples
+           is never built.'''
+        self.base = self.supStart = self.supRows = None
+        self.tupleSet = None
+        for chunk in self.chunks(tuples):
+            self.add_chunk(chunk)
+
+    CHUNK = 1 << 14
+
+    def chunks(self, tuples):
+        '''Internal routine. Generate the tuples as lists of at most
+           CHUNK tuples'''
+        if getattr(tuples, 'ndim', None) == 2:
+            #a NumPy array, converted a block of rows at a time
+            for start in range(0, len(tuples), self.CHUNK):
+                yield tuples[start:start + self.CHUNK].tolist()
+            return
+        it = iter(tuples)
+        while True:
+            chunk = list(itertools.islice(it, self.CHUNK))
+            if not chunk:
+                return
+            yield chunk
+
+    def add_chunk(self, tuples):
+        '''Internal routine. Add a list of tuples'''
+        try:
+            codes, columns = self.encode_all(tuples)
+        except (KeyError, TypeError, ValueError):
+            codes, columns = self.encode_each(tuples)
+
+        if self.nRows or len(set(codes)) != len(codes):
+            #drop the tuples already in the table and the repeats
+            seen = set()
+            picked = []
+            for p, code in enumerate(codes):
+                if code in seen or (self.nRows and self.has_code(code)):
+                    continue
+                seen.add(code)
+                picked.append(p)
+            codes = [codes[p] for p in picked]
+            columns = [[column[p] for p in picked] for column in columns]
+
+        if codes:
+            #interleave the columns into rows
+            k = len(columns)
+            typecode = self.data.typecode
+            block = array.array(typecode, [0]) * (len(codes) * k)
+            for i, column in enumerate(columns):
+                block[i::k] = array.array(typecode, column)
+            self.data.extend(block)
+            self.add_codes(codes)
+            self.nRows += len(codes)
+
+    def encode_all(self, tuples):
+        '''Internal routine. Return the codes of the tuples and the 
+           columns of their rows (a list of value indices per position), 
+           computed a column at a time. Raise an exception if some tuple
+           has the wrong length or a value outside its domain.'''
+        k = len(self.domains)
+        if not tuples:
+            return [], [[] for dom in self.domains]
+        if k == 0 or set(map(len, tuples)) != {k}:
+            raise ValueError
+        columns = [list(map(scaled_index(dom).__getitem__, column))
+                   for dom, column in zip(self.domains, zip(*tuples))]
+        codes = columns[-1]
+        mult = 1
+        for i in range(k - 2, -1, -1):
+            mult *= self.radix[i + 1]
+            codes = list(map(operator.add, codes, map(mult.__mul__, columns[i])))
+        return codes, columns
+
+    def encode_each(self, tuples):
+        '''Internal routine. As encode_all, but a tuple at a time, 
+           skipping the tuples of the wrong length or with a value outside
+           its domain'''
+        k = len(self.domains)
+        getitem = dict.__getitem__
+        indexes = [scaled_index(dom) for dom in self.domains]
+        codes = []
+        columns = [[] for dom in self.domains]
+        for t in tuples:
+            if len(t) != k:
+                continue
+            try:
+                code = sum(map(getitem, self.weights, t))
+                row = list(map(getitem, indexes, t))
+            except (KeyError, TypeError):
+                continue
+            codes.append(code)
+            for column, j in zip(columns, row):
+                column.append(j)
+        return codes, columns
+
+    def add_codes(self, new):
+        '''Internal routine. Add the codes of new rows (none of them 
+           already in the table)'''
+        n = self.nRows + len(new)
+        if self.bitmap is not None:
+            bitmap = self.bitmap
+            for code in new:
+                bitmap[code >> 3] |= 1 << (code & 7)
+        elif isinstance(self.codes, set):
+            self.codes.update(new)
+        elif self.space() <= 64 * n:
+            self.store_codes(itertools.chain(self.codes, new), n)
+        else:
+            #merge the sorted new codes into the sorted array, copying
+            #the runs of old codes in between as slices
+            old = self.codes
+            merged = array.array('q')
+            prev = 0
+            for code in sorted(new):
+                p = bisect.bisect_left(old, code, prev)
+                merged += old[prev:p]
+                merged.append(code)
+                prev = p
+            merged += old[prev:]
+            self.codes = merged
+
+    def space(self):
+        '''Internal routine. Return the number of possible codes'''
+        space = 1
+        for size in self.radix:
+            space *= size
+        return space
+
+    def store_codes(self, codes, n):
+        '''Internal routine. Keep the n codes in the structure suited to 
+           the size of the code space'''
+        space = self.space()
+        if space <= 64 * n:
+            nbytes = (space + 7) >> 3
+            if space <= 1 << 12:
+                #small: OR the bits into an int (all in C)
+                bits = functools.reduce(operator.or_, map((1).__lshift__, codes), 0)
+                bitmap = bytearray(bits.to_bytes(nbytes, 'little'))
+            else:
+                bitmap = bytearray(nbytes)
+                for code in codes:
+                    bitmap[code >> 3] |= 1 << (code & 7)
+            self.bitmap = bitmap
+            self.codes = None
+        elif space < 1 << 63:
+            self.codes = array.array('q', sorted(codes))
+            self.bitmap = None
+        else:
+            self.codes = set(codes)
+            self.bitmap = None
+
+    def recode(self, radix):
+        '''Internal routine. The domains changed: widen the row entries if
+           needed and recompute the codes with the new domain sizes'''
+        self.radix = radix
+        biggest = max(radix, default=0)
+        typecode = 'B' if biggest <= 1 << 8 else 'H' if biggest <= 1 << 16 else 'q'
+        if typecode != self.data.typecode:
+            self.data = array.array(typecode, self.data)
+        k = len(radix)
+        mults = [1] * k
+        for i in range(k - 2, -1, -1):
+            mults[i] = mults[i + 1] * radix[i + 1]
+        self.weights = [scaled_index(dom, m)
+                        for dom, m in zip(self.domains, mults)]
+        if self.nRows:
+            data = self.data
+            codes = [sum(j * m for j, m in zip(data[r * k:(r + 1) * k], mults))
+                     for r in range(self.nRows)]
+            self.store_codes(codes, self.nRows)
+
+    def build_supports(self):
+        '''Build the support index arrays'''
+        k = len(self.domains)
+        base = [0]
+        for dom in self.domains:
+            base.append(base[-1] + len(dom))
+        data = self.data
+        start = array.array('i', [0]) * (base[-1] + 1)
+        for r in range(self.nRows):
+            for i in range(k):
+                start[base[i] + data[r * k + i] + 1] += 1
+        for s in range(base[-1]):
+            start[s + 1] += start[s]
+        fill = array.array('i', start)
+        rows = array.array('i', [0]) * (self.nRows * k)
+        for r in range(self.nRows):
+            for i in range(k):
+                s = base[i] + data[r * k + i]
+                rows[fill[s]] = r
+                fill[s] += 1
+        self.base = base
+        self.supStart = start
+        self.supRows = rows
+
+    def row_is_valid(self, r, scope):
+        '''Check if every value of the r'th row is still in the current 
+           domain of the variable at its position in scope (in_cur_domain,
+           inlined)'''
+        k = len(scope)
+        data = self.data
+        o = r * k
+        for var in scope:
+            j = data[o]
+            o += 1
+            if var.assignedValue is not None:
+                if var.dom[j] != var.assignedValue:
+                    return False
+            elif not (var.curdom >> j) & 1:
+                return False
+        return True
+
+#The table of a constraint no tuples were added to (copied on the first add)
+EMPTY_TABLE = TupleTable()
+EMPTY_TABLE.shared = True
+
 class Constraint: 
     '''Class for defining constraints variable objects specifes an
        ordering over variables.  This ordering is used when calling
        the satisfied function which tests if an assignment to the
        variables in the constraint's scope satisfies the constraint'''
 
+    __slots__ = ('name', 'id', 'scope', 'sat_tuples', 'ct', 'residues', 'supportMode', 'nTupleChecks', 'nResidueHits',
+                 'weight', 'nUnasgn', 'unasgnXor')
+
     def __init__(self, name, scope): 
         '''create a constraint object, specify the constraint name (a
         string) and its scope (an ORDERED list of variable objects).
@@ -214,34 +681,117 @@ class Constraint:
         in the scope such that this sequence of values satisfies the
         constraints).
 
-        NOTE: This is a very space expensive representation...a proper
-        constraint object would allow for representing the constraint
-        with a function.  
+        NOTE: This is a very space expensive representation...see
+        FunctionConstraint for a constraint represented by a function.
+        The tuples are kept compactly in a TupleTable, which also holds
+        the index of the tuples supporting each variable/value pair 
+        used to help support GAC propagation. Constraints over the same
+        relation can share one table, see use_relation and 
+        table_constraint.
         '''
 
         self.scope = list(scope)
         self.name = name
-        self.sat_tuples = dict()
-
-        #The next object data item 'sup_tuples' will be used to help
-        #support GAC propgation. It allows access to a list of 
-        #satisfying tuples that contain a particular variable/value
-        #pair.
-        self.sup_tuples = dict()
+        self.id = None          #position in the CSP's constraint list
+        self.sat_tuples = EMPTY_TABLE
+
+        #Compact-Table state, built from the tuples on demand by prop_CT
+        self.ct = None
+
+        #Residual supports for has_support: residues[s] is the index
+        #among the supports of slot s (see TupleTable) of the last 
+        #support found. See set_support_mode.
+        self.residues = None
+        self.supportMode = 'residue'
+
+        #counters: tuples tested by has_support, and how many calls
+        #were answered by the residue alone
+        self.nTupleChecks = 0
+        self.nResidueHits = 0
+
+        #number of wipeouts caused (plus one), for the dom/wdeg heuristic.
+        #Bumped by the propagators, reset at the start of each search.
+        self.weight = 1
+
+        #number of unassigned variables in the scope and the XOR of their
+        #positions, kept up to date by Variable.assign/unassign. When one
+        #variable is left unassigned the XOR is its position.
+        self.nUnasgn = 0
+        self.unasgnXor = 0
+        for i, var in enumerate(self.scope):
+            var.scopePositions.append((self, i))
+            if not var.is_assigned():
+                self.nUnasgn += 1
+                self.unasgnXor ^= i
 
     def add_satisfying_tuples(self, tuples):
-        '''We specify the constraint by adding its complete list of satisfying tuples.'''
-        for x in tuples:
-            t = tuple(x)  #ensure we have an immutable tuple
-            if not t in self.sat_tuples:
-                self.sat_tuples[t] = True
-
-            #now put t in as a support for all of the variable values in it
-            for i, val in enumerate(t):
-                var = self.scope[i]
-                if not (var,val) in self.sup_tuples:
-                    self.sup_tuples[(var,val)] = []
-                self.sup_tuples[(var,val)].append(t)
+        '''We specify the constraint by adding its complete list of satisfying tuples.
+           Any iterable will do, e.g., a generator, and it is consumed a
+           chunk at a time, so the tuples need not all be in memory at
+           once. A 2 dimensional NumPy array (one row per tuple) is also
+           accepted.'''
+        self.ct = None
+        self.residues = None
+        self.own_table().add(tuples)
+
+    def use_relation(self, table):
+        '''Take the TupleTable table as the satisfying tuples, in place
+           of any added so far. The table can be shared with other 
+           constraints (e.g., one returned by relation), it is copied 
+           before tuples are added to this constraint. Its domains must 
+           be the domains of the scope variables, in scope order.'''
+        if table.domains != [tuple(var.dom) for var in self.scope]:
+            print("ERROR: relation domains do not match the scope of", self)
+            return
+        self.ct = None
+        self.residues = None
+        self.sat_tuples = table
+
+    def own_table(self):
+        '''Internal routine. Return the tuple table, copied first if it
+           is shared, over the current domains of the scope variables'''
+        table = self.sat_tuples
+        if table.shared:
+            table = self.sat_tuples = table.copy()
+        table.set_domains([var.dom for var in self.scope])
+        return table
+
+    def load_satisfying_tuples(self, path, typecode='i', convert=int):
+        '''Add the satisfying tuples stored in the file path. The file is
+           memory mapped and read a chunk at a time, so it can be much
+           bigger than the memory the tuples take once stored.
+
+           A file whose name ends in .csv has one tuple per line, its 
+           values separated by commas, each converted by convert. Any 
+           other file is binary: the values of the tuples one after the
+           other, each a machine value of the array module's typecode
+           (e.g., 'i' for C ints, 'b' for signed bytes), in native byte
+           order, as written by array.tofile.'''
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                if path.endswith('.csv'):
+                    self.add_satisfying_tuples(csv_tuples(buf, convert))
+                else:
+                    self.add_satisfying_tuples(
+                        binary_tuples(buf, typecode, len(self.scope)))
+
+    def get_supports(self):
+        '''Return the tuple table with its support index built (see
+           TupleTable). Built on first use (only the GAC style 
+           propagators need it), so the domains should be complete by 
+           then. The index of a shared table is shared too.'''
+        table = self.sat_tuples
+        if table.radix != [len(var.dom) for var in self.scope]:
+            #no tuples yet or the domains grew since: catch up
+            table = self.own_table()
+        if table.supStart is None:
+            table.build_supports()
+            self.residues = None
+        if self.residues is None:
+            self.residues = array.array('i', [0]) * table.base[-1]
+        return table
 
     def get_scope(self):
         '''get list of variables the constraint is over'''
@@ -254,52 +804,724 @@ class Constraint:
            constraints "satisfies" function.  Note the list of values
            are must be ordered in the same order as the list of
            variables in the constraints scope'''
-        return tuple(vals) in self.sat_tuples
+        return vals in self.sat_tuples
+
+    def revision_cost(self):
+        '''Rough estimate of the work of revising the constraint (making 
+           it GAC), used to order the propagation queue (see 
+           propagators.constraint_cost): the number of satisfying tuples'''
+        return len(self.sat_tuples)
 
     def get_n_unasgn(self):
         '''return the number of unassigned variables in the constraint's scope'''
-        n = 0
-        for v in self.scope:
-            if not v.is_assigned():
-                n = n + 1
-        return n
+        return self.nUnasgn
 
     def get_unasgn_vars(self): 
         '''return list of unassigned variables in constraint's scope. Note
            more expensive to get the list than to then number'''
+        if self.nUnasgn == 0:
+            return []
+        if self.nUnasgn == 1:
+            return [self.scope[self.unasgnXor]]
         vs = []
         for v in self.scope:
             if not v.is_assigned():
                 vs.append(v)
         return vs
 
-    def has_support(self, var, val):
+    def get_last_unasgn(self):
+        '''return the position in the scope of the only unassigned
+           variable of the constraint. Only meaningful when get_n_unasgn()
+           is 1.'''
+        return self.unasgnXor
+
+    def set_support_mode(self, mode):
+        '''Choose how has_support looks for a supporting tuple
+           'scan'     -- scan the supports of (var,val) from the start every time
+           'residue'  -- first try the last support found for (var,val)
+                         (its residue), scan from the start if it is no 
+                         longer valid (AC-3rm). This is the default.
+           'circular' -- first try the residue, then scan on from just
+                         after it, wrapping around. The scan position is
+                         kept across backtracks.'''
+        if not mode in ('scan', 'residue', 'circular'):
+            print("ERROR: unknown support mode", mode)
+            return
+        self.supportMode = mode
+
+    def clear_stats(self):
+        '''Reset the support counters'''
+        self.nTupleChecks = 0
+        self.nResidueHits = 0
+
+    def has_support(self, var, val, i=None):
         '''Test if a variable value pair has a supporting tuple (a set
            of assignments satisfying the constraint where each value is
-           still in the corresponding variables current domain
+           still in the corresponding variables current domain. i is 
+           the position of var in the scope, if known.
         '''
-        if (var, val) in self.sup_tuples:
-            for t in self.sup_tuples[(var, val)]:
-                if self.tuple_is_valid(t):
-                    return True
+        if i is None:
+            i = self.scope.index(var)
+        j = var.valIndex.get(val)
+        if j is None:
+            return False
+        table = self.sat_tuples
+        if table.supStart is None or self.residues is None or j >= table.radix[i]:
+            #no index yet, or val was added to the domain after it was built
+            table = self.get_supports()
+        s = table.base[i] + j
+        lo = table.supStart[s]
+        n = table.supStart[s + 1] - lo
+        if n == 0:
+            return False
+        sup = table.supRows
+        valid = table.row_is_valid
+        scope = self.scope
+
+        if self.supportMode == 'scan':
+            order = range(n)
+        else:
+            residues = self.residues
+            r = residues[s]
+            self.nTupleChecks += 1
+            if valid(sup[lo + r], scope):
+                self.nResidueHits += 1
+                return True
+            if self.supportMode == 'residue':
+                order = itertools.chain(range(r), range(r + 1, n))
+            else:
+                order = itertools.chain(range(r + 1, n), range(r))
+
+        for k in order:
+            self.nTupleChecks += 1
+            if valid(sup[lo + k], scope):
+                if self.supportMode != 'scan':
+                    residues[s] = k
+                return True
         return False
 
-    def tuple_is_valid(self, t):
-        '''Internal routine. Check if every value in tuple is still in
-           corresponding variable domains'''
+    def find_unsupported(self, changed=None):
+        '''Generate the (var, val) pairs of the scope's current domains
+           that have no support. Used by GAC_Enforce, which may prune each
+           pair before asking for the next one. Subclasses that can filter
+           the whole scope at once (e.g., AllDiffConstraint) override this.
+
+           If changed is a variable of the scope, only its domain changed
+           since the constraint was last made GAC. The values of changed
+           then keep their supports, so only the other variables are
+           revised.'''
         for i, var in enumerate(self.scope):
-            if not var.in_cur_domain(t[i]):
-                return False
-        return True
+            if var is changed:
+                continue
+            for val in var.cur_domain():
+                if not self.has_support(var, val, i):
+                    yield var, val
 
     def __str__(self):
         return("{}({})".format(self.name,[var.name for var in self.scope]))
 
+def sum_tuples(domains, target):
+    '''Generate the tuples of values, one from each domain, that sum to
+       target, in the order of itertools.product. A partial tuple is only
+       extended while the rest of the domains can still make up the sum.'''
+    n = len(domains)
+    if not all(domains):
+        return
+    lo = [0] * (n + 1)      #smallest and largest sums of domains[i:]
+    hi = [0] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        lo[i] = lo[i + 1] + min(domains[i])
+        hi[i] = hi[i + 1] + max(domains[i])
+    vals = []
+
+    def extend(i, total):
+        if i == n:
+            if total == target:
+                yield tuple(vals)
+            return
+        for v in domains[i]:
+            if lo[i + 1] <= target - total - v <= hi[i + 1]:
+                vals.append(v)
+                yield from extend(i + 1, total + v)
+                vals.pop()
+
+    yield from extend(0, 0)
+
+def filtered_tuples(domains, pred, *params):
+    '''Generate the tuples of values, one from each domain, accepted by 
+       pred(vals, *params)'''
+    return (t for t in itertools.product(*domains) if pred(t, *params))
+
+#The relation kinds known by name: kind --> function(domains, *params)
+#generating the tuples of the relation (see RelationCache)
+RELATIONS = {
+    'neq': lambda domains: filtered_tuples(domains, lambda t: t[0] != t[1]),
+    'eq': lambda domains: filtered_tuples(domains, lambda t: len(set(t)) <= 1),
+    'alldiff': lambda domains: filtered_tuples(domains, lambda t: len(set(t)) == len(t)),
+    'sum': sum_tuples,
+}
+
+class RelationCache:
+    '''Size bounded cache of the tuple tables of canonical relations, 
+       shared read only by the constraints (of any number of CSPs) over
+       them. A relation is named by its kind, the domains it is over 
+       (one per scope position) and its parameters, e.g.,
+
+          ('neq', ((0,...,9), (0,...,9)), ())     X != Y
+          ('sum', ((0,...,9),)*3, (12,))          X + Y + Z == 12
+
+       The kind is a key of RELATIONS or a function pred(vals, *params)
+       returning True for the satisfying tuples (the function itself 
+       names the relation, so use a module level function, not a lambda
+       made anew for each constraint). The parameters must be hashable.
+
+       The table of a relation is built the first time it is asked for
+       and marked shared; later requests return the same table, so 
+       building another constraint over it costs no tuple enumeration.
+       Its support index (see TupleTable) is built once as well. When
+       the cache holds maxRelations tables the least recently used is
+       dropped, the constraints using it keep it.'''
+
+    def __init__(self, maxRelations=256):
+        self.maxRelations = maxRelations
+        self.tables = collections.OrderedDict()     #key --> table, LRU first
+        self.nHits = 0
+        self.nBuilt = 0
+
+    def __len__(self):
+        return len(self.tables)
+
+    def get(self, kind, domains, params=()):
+        '''Return the shared TupleTable of the relation, or None if kind
+           is unknown'''
+        domains = tuple(tuple(dom) for dom in domains)
+        key = (kind, domains, tuple(params))
+        table = self.tables.get(key)
+        if table is not None:
+            self.tables.move_to_end(key)
+            self.nHits += 1
+            return table
+        if callable(kind):
+            tuples = filtered_tuples(domains, kind, *params)
+        elif kind in RELATIONS:
+            tuples = RELATIONS[kind](domains, *params)
+        else:
+            print("ERROR: unknown relation kind", kind)
+            return None
+        table = TupleTable(domains)
+        table.add(tuples)
+        table.shared = True
+        self.nBuilt += 1
+        if self.maxRelations > 0:
+            if len(self.tables) >= self.maxRelations:
+                self.tables.popitem(last=False)
+            self.tables[key] = table
+        return table
+
+    def set_max_relations(self, maxRelations):
+        '''Bound the number of tables kept, dropping the least recently
+           used ones if there are more. 0 turns caching off.'''
+        self.maxRelations = maxRelations
+        while len(self.tables) > max(maxRelations, 0):
+            self.tables.popitem(last=False)
+
+    def clear(self):
+        '''Drop all the tables and reset the counters'''
+        self.tables.clear()
+        self.nHits = 0
+        self.nBuilt = 0
+
+#The cache used by relation and table_constraint
+relations = RelationCache()
+
+def relation(kind, domains, *params):
+    '''Return the shared TupleTable of a relation (see RelationCache) over
+       domains, a list of domains (lists of values). E.g., 
+       relation('sum', [x.domain(), y.domain()], 10)'''
+    return relations.get(kind, domains, params)
+
+def table_constraint(name, scope, kind, *params):
+    '''Return a new Constraint over scope whose satisfying tuples are 
+       the shared table of the relation kind (see RelationCache) over the
+       domains of the scope variables. E.g., 
+       table_constraint('C1', [x, y], 'neq')'''
+    con = Constraint(name, scope)
+    table = relation(kind, [var.dom for var in scope], *params)
+    if table is not None:
+        con.use_relation(table)
+    return con
+
+class FunctionConstraint(Constraint):
+    '''Intensional constraint: instead of a table of satisfying tuples
+       the constraint is given by a function
+
+       func(vals) ==> True/False
+
+       where vals is a list of values, one for each variable of the scope
+       (in scope order). No tuples are ever materialized: check calls func
+       directly and has_support searches the current domains of the other
+       scope variables for a satisfying combination, stopping at the first
+       one found.
+
+       Optionally a function
+
+       partial(vals, k) ==> True/False
+
+       can be given. It is called with the first k entries of vals filled
+       in and should return False if no extension of these k values can
+       satisfy the constraint. This lets has_support cut off whole subtrees
+       of the search instead of enumerating every combination.'''
+
+    def __init__(self, name, scope, func, partial=None):
+        Constraint.__init__(self, name, scope)
+        self.func = func
+        self.partial = partial
+
+    def add_satisfying_tuples(self, tuples):
+        print("ERROR: cannot add satisfying tuples to function constraint", self)
+
+    def check(self, vals):
+        '''Return true if and only if func accepts vals'''
+        return bool(self.func(vals))
+
+    def revision_cost(self):
+        '''has_support may search all the combinations of domain values:
+           the product of the domain sizes'''
+        cost = 1
+        for var in self.scope:
+            cost *= len(var.dom)
+        return cost
+
+    def has_support(self, var, val, i=None):
+        '''Test if a variable value pair has a supporting tuple by 
+           searching over the current domains of the other variables'''
+        doms = []
+        for v in self.scope:
+            if v is var:
+                doms.append([val])
+            else:
+                doms.append(v.cur_domain())
+        return self.find_support(doms)
+
+    def find_support(self, doms):
+        '''Internal routine. Depth first search (without recursion) for
+           a list of values, one from each list in doms, satisfying func.
+           Return True as soon as one is found'''
+        n = len(doms)
+        if n == 0:
+            return self.check([])
+        for d in doms:
+            if not d:
+                return False
+        partial = self.partial
+        vals = [None] * n
+        pos = [0] * n
+        k = 0
+        while k >= 0:
+            if pos[k] == len(doms[k]):
+                pos[k] = 0
+                k -= 1
+                if k >= 0:
+                    pos[k] += 1
+                continue
+            vals[k] = doms[k][pos[k]]
+            if k == n - 1:
+                if self.func(vals):
+                    return True
+                pos[k] += 1
+            elif partial is not None and not partial(vals, k + 1):
+                pos[k] += 1
+            else:
+                k += 1
+        return False
+
+class AllDiffConstraint(Constraint):
+    '''Global all-different constraint: the variables of the scope must
+       all take different values. No tuples are stored.
+
+       GAC filtering uses Regin's algorithm: find a maximum matching
+       between the variables and their current values, and keep a value
+       only if its edge belongs to some maximum matching (it is in the
+       matching, lies on an alternating cycle, i.e., inside a strongly 
+       connected component of the oriented value graph, or lies on an 
+       alternating path from a free value).'''
+
+    def __init__(self, name, scope):
+        Constraint.__init__(self, name, scope)
+
+    def add_satisfying_tuples(self, tuples):
+        print("ERROR: cannot add satisfying tuples to all-different constraint", self)
+
+    def check(self, vals):
+        '''Return true if and only if all the values are different'''
+        return len(set(vals)) == len(vals)
+
+    def revision_cost(self):
+        '''The matching and its alternating paths take about the number
+           of variables times the number of (variable, value) edges'''
+        return len(self.scope) * sum(len(var.dom) for var in self.scope)
+
+    def has_support(self, var, val, i=None):
+        '''Test if var=val can be extended to all-different values for
+           the rest of the scope (from their current domains)'''
+        doms = []
+        for v in self.scope:
+            if v is var:
+                doms.append([val])
+            else:
+                doms.append(v.cur_domain())
+        match = self.max_matching(doms)
+        return not None in match
+
+    def find_unsupported(self, changed=None):
+        '''Generate every (var, val) pair whose edge is in no maximum
+           matching. If the variables cannot all be matched no value has
+           a support, so every pair is generated. The pairs of changed are
+           skipped, see Constraint.find_unsupported.'''
+        doms = [var.cur_domain() for var in self.scope]
+        match = self.max_matching(doms)
+        if None in match:
+            for i, var in enumerate(self.scope):
+                for val in doms[i]:
+                    yield var, val
+            return
+
+        comp, reached = self.value_graph_components(doms, match)
+        for i, var in enumerate(self.scope):
+            if var is changed:
+                continue
+            for val in doms[i]:
+                if val != match[i] and not val in reached and comp[i] != comp[(val,)]:
+                    yield var, val
+
+    def max_matching(self, doms):
+        '''Internal routine. Return list giving the value matched to 
+           each variable (by position) in a maximum matching, None for 
+           unmatched variables. Augmenting paths are found by breadth
+           first search.'''
+        n = len(doms)
+        match = [None] * n
+        owner = dict()      #value --> position of the variable matched to it
+        for i in range(n):
+            #cheap start: take a free value if there is one
+            for val in doms[i]:
+                if not val in owner:
+                    match[i] = val
+                    owner[val] = i
+                    break
+        for i in range(n):
+            if match[i] is not None:
+                continue
+            parent = {i: None}      #variable --> (previous variable, value)
+            frontier = [i]
+            found = None
+            while frontier and found is None:
+                nxt = []
+                for x in frontier:
+                    for val in doms[x]:
+                        y = owner.get(val)
+                        if y is None:
+                            found = (x, val)
+                            break
+                        if not y in parent:
+                            parent[y] = (x, val)
+                            nxt.append(y)
+                    if found is not None:
+                        break
+                frontier = nxt
+            if found is None:
+                continue
+            x, val = found
+            while True:
+                match[x] = val
+                owner[val] = x
+                if parent[x] is None:
+                    break
+                x, val = parent[x]
+        return match
+
+    def value_graph_components(self, doms, match):
+        '''Internal routine. Orient the value graph (matching edges from
+           variable to value, other edges from value to variable) and
+           return (comp, reached): comp maps each node (variable position,
+           or (value,) for a value) to its strongly connected component, 
+           and reached is the set of values reachable from a free value.'''
+        succ = dict()
+        for i, dom in enumerate(doms):
+            succ.setdefault(i, [])
+            for val in dom:
+                node = (val,)
+                succ.setdefault(node, [])
+                if val == match[i]:
+                    succ[i].append(node)
+                else:
+                    succ[node].append(i)
+
+        matched = set(match)
+        reached = set()
+        stack = [node for node in succ 
+                 if type(node) is tuple and not node[0] in matched]
+        seen = set(stack)
+        while stack:
+            node = stack.pop()
+            if type(node) is tuple:
+                reached.add(node[0])
+            for nxt in succ[node]:
+                if not nxt in seen:
+                    seen.add(nxt)
+                    stack.append(nxt)
+
+        #Tarjan's algorithm, without recursion
+        comp = dict()
+        index = dict()
+        low = dict()
+        onstack = set()
+        tstack = []
+        counter = 0
+        for root in succ:
+            if root in index:
+                continue
+            work = [(root, 0)]
+            index[root] = low[root] = counter
+            counter += 1
+            tstack.append(root)
+            onstack.add(root)
+            while work:
+                node, k = work[-1]
+                if k < len(succ[node]):
+                    work[-1] = (node, k + 1)
+                    nxt = succ[node][k]
+                    if not nxt in index:
+                        index[nxt] = low[nxt] = counter
+                        counter += 1
+                        tstack.append(nxt)
+                        onstack.add(nxt)
+                        work.append((nxt, 0))
+                    elif nxt in onstack:
+                        low[node] = min(low[node], index[nxt])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == index[node]:
+                        while True:
+                            w = tstack.pop()
+                            onstack.discard(w)
+                            comp[w] = index[node]
+                            if w == node:
+                                break
+        return comp, reached
+
+class LinearSumConstraint(Constraint):
+    '''Linear equation over numeric variables:
+
+       coeffs[0]*scope[0] + coeffs[1]*scope[1] + ... == target
+
+       Only the scope, coefficients and target are stored, no tuples.
+
+       Filtering is by bounds: the minimum and maximum of each term are
+       summed once, and a value v of variable i is kept only if
+       target - coeffs[i]*v lies between the minimum and maximum that 
+       the other terms can still reach. With domain_consistent=True the
+       filtering is exact (GAC) instead: the sets of partial sums 
+       reachable by the variables before and after position i are built
+       by dynamic programming, and v is kept only if some pair of them 
+       completes the sum.'''
+
+    def __init__(self, name, scope, coeffs, target, domain_consistent=False):
+        Constraint.__init__(self, name, scope)
+        self.coeffs = list(coeffs)
+        self.target = target
+        self.domainConsistent = domain_consistent
+
+    def add_satisfying_tuples(self, tuples):
+        print("ERROR: cannot add satisfying tuples to linear sum constraint", self)
+
+    def check(self, vals):
+        '''Return true if and only if the values satisfy the equation'''
+        total = 0
+        for a, v in zip(self.coeffs, vals):
+            total += a * v
+        return total == self.target
+
+    def revision_cost(self):
+        '''Bounds filtering takes a pass over the domains; the dynamic
+           programming of domain_consistent up to one over the reachable
+           sums per (variable, value)'''
+        size = sum(len(var.dom) for var in self.scope)
+        if not self.domainConsistent:
+            return size
+        return size * max(1, size)
+
+    def has_support(self, var, val, i=None):
+        '''Test if var=val can be completed to a solution of the equation
+           using the current domains of the other variables'''
+        sums = {0}
+        for a, v in zip(self.coeffs, self.scope):
+            if v is var:
+                sums = {s + a * val for s in sums}
+            else:
+                sums = {s + a * x for s in sums for x in v.cur_domain()}
+        return self.target in sums
+
+    def find_unsupported(self, changed=None):
+        '''Generate the (var, val) pairs removed by bounds (or, if
+           domain_consistent, exact) filtering. The pairs of changed are
+           skipped, see Constraint.find_unsupported.'''
+        doms = [var.cur_domain() for var in self.scope]
+        terms = [[a * v for v in dom] for a, dom in zip(self.coeffs, doms)]
+        lows = [min(t) if t else 0 for t in terms]
+        highs = [max(t) if t else 0 for t in terms]
+        low = sum(lows)
+        high = sum(highs)
+        target = self.target
+
+        if not (low <= target <= high) or [] in doms:
+            for var, dom in zip(self.scope, doms):
+                for val in dom:
+                    yield var, val
+            return
+
+        if not self.domainConsistent:
+            for i, var in enumerate(self.scope):
+                if var is changed:
+                    continue
+                #bounds of the other terms, derived from the totals
+                lo = target - (high - highs[i])
+                hi = target - (low - lows[i])
+                for val, t in zip(doms[i], terms[i]):
+                    if t < lo or t > hi:
+                        yield var, val
+            return
+
+        #after[i] = sums reachable by the terms at positions i, i+1, ...
+        n = len(self.scope)
+        after = [None] * (n + 1)
+        after[n] = {0}
+        for i in range(n - 1, -1, -1):
+            after[i] = {s + t for s in after[i + 1] for t in set(terms[i])}
+        before = {0}
+        for i, var in enumerate(self.scope):
+            rest = after[i + 1]
+            for val, t in zip(doms[i], terms[i]):
+                if var is changed:
+                    break
+                need = target - t
+                if not any((need - s) in rest for s in before):
+                    yield var, val
+            before = {s + t for s in before for t in set(terms[i])}
+
+class Trail:
+    '''Solver-wide undo stack used to restore state on backtrack.
+
+       Objects that change reversible state (e.g., a Variable pruning a
+       value) record an entry (owner, data). Undoing an entry calls
+       owner.trail_undo(data). Entries are undone in reverse order.
+
+       The search pushes a level marker before each decision and pops
+       back to it when the decision is retracted, so nothing needs to
+       remember which values were pruned at which node.
+
+       The stack is a pair of preallocated lists that double in size
+       when full, so recording does not allocate per entry.
+
+       Each level marker also gets a unique stamp. Objects that save a
+       snapshot of their state (rather than one entry per change) can
+       compare the current stamp with the one they last saved at to
+       record at most one snapshot per level.'''
+
+    def __init__(self, capacity=1024):
+        self.owners = [None] * capacity
+        self.datas = [None] * capacity
+        self.top = 0            #number of entries on the trail
+        self.levels = []        #stack of level markers (trail positions)
+        self.stamps = []        #stamps of the enclosing levels
+        self.stamp = 0          #stamp of the current level
+        self.nStamps = 0        #number of stamps handed out so far
+        self.nPrunings = 0      #number of value prunings ever recorded
+
+    def record_pruning(self, var, i):
+        '''Record that var's i'th domain value was pruned'''
+        self.nPrunings += 1
+        self.record(var, i)
+
+    def record(self, owner, data):
+        '''Push an undo entry onto the trail'''
+        top = self.top
+        if top == len(self.owners):
+            self.owners.extend([None] * top)
+            self.datas.extend([None] * top)
+        self.owners[top] = owner
+        self.datas[top] = data
+        self.top = top + 1
+
+    def mark(self):
+        '''Return the current trail position'''
+        return self.top
+
+    def undo_to(self, mark):
+        '''Undo all entries recorded after trail position mark'''
+        owners = self.owners
+        datas = self.datas
+        top = self.top
+        while top > mark:
+            top -= 1
+            owners[top].trail_undo(datas[top])
+            owners[top] = None
+        self.top = top
+
+    def push_level(self):
+        '''Place a level marker at the current trail position'''
+        self.levels.append(self.top)
+        self.stamps.append(self.stamp)
+        self.nStamps += 1
+        self.stamp = self.nStamps
+
+    def pop_level(self):
+        '''Undo everything recorded since the last level marker and
+           remove that marker'''
+        self.undo_to(self.levels.pop())
+        self.stamp = self.stamps.pop()
+
+    def backtrack_to(self, depth):
+        '''Pop level markers until only depth of them remain, undoing
+           everything recorded since'''
+        if depth < len(self.levels):
+            self.undo_to(self.levels[depth])
+            self.stamp = self.stamps[depth]
+            del self.levels[depth:]
+            del self.stamps[depth:]
+
+    def depth(self):
+        '''Return the number of level markers on the trail'''
+        return len(self.levels)
+
+    def clear(self):
+        '''Drop all entries and markers WITHOUT undoing them'''
+        for i in range(self.top):
+            self.owners[i] = None
+        self.top = 0
+        self.levels = []
+        self.stamps = []
+        self.nStamps += 1
+        self.stamp = self.nStamps
+
 class CSP:
     '''Class for packing up a set of variables into a CSP problem.
        Contains various utility routines for accessing the problem.
        The variables of the CSP can be added later or on initialization.
-       The constraints must be added later'''
+       The constraints must be added later.
+
+       Variables and constraints are numbered in the order they are 
+       added (their id). The constraints over each variable are kept in
+       compressed sparse row form: conList holds them grouped by 
+       variable, those over the variable with id i being 
+       conList[conStart[i]:conStart[i+1]]. This is rebuilt on the first
+       query after a change. As the ids (and the trail) of the variables
+       belong to their CSP, a variable can only be in one CSP at a time:
+       add_var refuses a variable of another CSP that is still in use.
+       A constraint should only be added to one CSP.'''
 
     def __init__(self, name, vars=[]):
         '''create a CSP object. Specify a name (a string) and 
@@ -308,7 +1530,11 @@ class CSP:
         self.name = name
         self.vars = []
         self.cons = []
-        self.vars_to_cons = dict()
+        self.conStart = None    #CSR offsets (array of ints), None if stale
+        self.conList = None     #constraints grouped by variable
+        self.trail = Trail()    #undo stack shared by all variables of the CSP
+        self.conflicts = None   #ConflictSets of a backjumping search, if any
+        self.timer = None       #SearchTimer of a timed search, if any
         for v in vars:
             self.add_var(v)
 
@@ -317,24 +1543,53 @@ class CSP:
            to obtain the constraints over this variable'''
         if not type(v) is Variable:
             print("Trying to add non variable ", v, " to CSP object")
-        elif v in self.vars_to_cons:
+        elif self.has_var(v):
             print("Trying to add variable ", v, " to CSP object that already has it")
+        elif v.owner is not None and v.owner() is not None:
+            print("ERROR: variable", v, "already belongs to CSP", v.owner().name,
+                  "so it is not added to", self.name)
         else:
+            v.id = len(self.vars)
+            v.owner = weakref.ref(self)
             self.vars.append(v)
-            self.vars_to_cons[v] = []
+            self.conStart = None
+            v.trail = self.trail
+
+    def has_var(self, v):
+        '''Return True if v is a variable of the CSP'''
+        return v.id is not None and v.id < len(self.vars) and self.vars[v.id] is v
 
     def add_constraint(self,c):
         '''Add constraint to CSP. Note that all variables in the 
            constraints scope must already have been added to the CSP'''
-        if not type(c) is Constraint:
+        if not isinstance(c, Constraint):
             print("Trying to add non constraint ", c, " to CSP object")
         else:
             for v in c.scope:
-                if not v in self.vars_to_cons:
+                if not self.has_var(v):
                     print("Trying to add constraint ", c, " with unknown variables to CSP object")
                     return
-                self.vars_to_cons[v].append(c)
+            c.id = len(self.cons)
             self.cons.append(c)
+            self.conStart = None
+
+    def build_adjacency(self):
+        '''Internal routine. Build the CSR index of the constraints over
+           each variable (in the order the constraints were added)'''
+        start = array.array('i', [0]) * (len(self.vars) + 1)
+        for c in self.cons:
+            for v in c.scope:
+                start[v.id + 1] += 1
+        for i in range(len(self.vars)):
+            start[i + 1] += start[i]
+        fill = array.array('i', start)
+        conList = [None] * start[-1]
+        for c in self.cons:
+            for v in c.scope:
+                conList[fill[v.id]] = c
+                fill[v.id] += 1
+        self.conList = conList
+        self.conStart = start
 
     def get_all_cons(self):
         '''return list of all constraints in the CSP'''
@@ -342,7 +1597,9 @@ class CSP:
         
     def get_cons_with_var(self, var):
         '''return list of constraints that include var in their scope'''
-        return list(self.vars_to_cons[var])
+        if self.conStart is None:
+            self.build_adjacency()
+        return self.conList[self.conStart[var.id]:self.conStart[var.id + 1]]
 
     def get_all_vars(self):
         '''return list of variables in the CSP'''
@@ -364,6 +1621,531 @@ class CSP:
 # Backtracking Routine                                 #
 ########################################################
 
+class MRVQueue:
+    '''Bucket queue of the unassigned variables keyed by current domain
+       size, used by BT to pick a minimum remaining values variable.
+
+       Bucket k holds the queued variables whose current domain has k
+       values, as a bitset (a python int) over the variables' positions
+       in the list given on creation. The queue is installed as the 
+       listener of every variable, so a variable moves to its new bucket
+       whenever a value is pruned or restored. Extraction takes the
+       lowest set bit of the smallest non-empty bucket: ties are broken
+       by position (i.e., CSP order), independently of the order in 
+       which domains happened to change, and every operation is a 
+       constant number of word-level bit operations.'''
+
+    def __init__(self, vars):
+        self.vars = list(vars)
+        self.index = dict()     #var --> position in self.vars
+        maxsize = 0
+        for i, v in enumerate(self.vars):
+            self.index[v] = i
+            maxsize = max(maxsize, v.domain_size())
+        self.buckets = [0] * (maxsize + 1)
+        self.where = dict()     #queued var --> bucket it is in
+        self.minSize = 0        #no non-empty bucket below this one
+        for v in self.vars:
+            self.add(v)
+
+    def __len__(self):
+        return len(self.where)
+
+    def add(self, var):
+        '''Put var into the bucket of its current domain size'''
+        size = var.cur_domain_size()
+        self.buckets[size] |= 1 << self.index[var]
+        self.where[var] = size
+        if size < self.minSize:
+            self.minSize = size
+
+    def remove(self, var):
+        '''Take var out of the queue'''
+        size = self.where.pop(var)
+        self.buckets[size] ^= 1 << self.index[var]
+
+    def domain_changed(self, var):
+        '''Listener callback: move var to its new bucket'''
+        size = self.where.get(var)
+        if size is not None:
+            bit = 1 << self.index[var]
+            self.buckets[size] ^= bit
+            size = var.cur_domain_size()
+            self.buckets[size] |= bit
+            self.where[var] = size
+            if size < self.minSize:
+                self.minSize = size
+
+    def extract_min(self):
+        '''Remove and return a variable with smallest current domain
+           (None if the queue is empty)'''
+        if not self.where:
+            return None
+        buckets = self.buckets
+        size = self.minSize
+        while not buckets[size]:
+            size += 1
+        self.minSize = size
+        bits = buckets[size]
+        low = bits & -bits
+        buckets[size] = bits ^ low
+        var = self.vars[low.bit_length() - 1]
+        del self.where[var]
+        return var
+
+class SupportCounts:
+    '''Support counts for the least constraining value ordering.
+
+       count[(V, val)] is the number of satisfying tuples of the table 
+       constraints (those with sat_tuples) on V that contain val for V
+       and are still valid, i.e., have every value in the current domain
+       of its variable. A value with many supports leaves many options
+       open to the other variables.
+
+       The counts are kept up to date incrementally, AC-4 style: for each
+       tuple we keep the number of its values that are not current, and
+       when a value is pruned (or restored) only the tuples in its 
+       list of supports are updated, a tuple that becomes invalid (valid)
+       decrementing (incrementing) the counts of all its values. The 
+       object is installed as the variables' listener, so prunings made
+       by any propagator and their undoing on backtrack are both seen. 
+       Variable.assign and unassign notify the listener too: the current
+       domain of an assigned variable counts as its assigned value alone.
+       It passes every notification on to listener (the variable queue).'''
+
+    def __init__(self, csp, listener=None):
+        self.listener = listener
+        self.count = dict()     #(var, val) --> number of valid tuples
+        self.dead = dict()      #constraint --> row --> non-current values
+        #var id --> (table constraint on var, position of var) pairs
+        self.cons = [[] for v in csp.vars]
+        #var id --> current domain bits (see live) at the last notification
+        self.curdom = [self.live(v) for v in csp.vars]
+        count = self.count
+        for c in csp.cons:
+            if not c.sat_tuples:
+                continue
+            table = c.get_supports()
+            k = len(c.scope)
+            dead = array.array('i', [0]) * len(table)
+            self.dead[c] = dead
+            bits = [self.curdom[x.id] for x in c.scope]
+            for r in range(len(table)):
+                d = 0
+                for i in range(k):
+                    if not (bits[i] >> table.data[r * k + i]) & 1:
+                        d += 1
+                dead[r] = d
+                if d == 0:
+                    for pair in zip(c.scope, table.row(r)):
+                        count[pair] = count.get(pair, 0) + 1
+            for i, x in enumerate(c.scope):
+                self.cons[x.id].append((c, i))
+
+    def live(self, var):
+        '''Return the current domain of var as a bitmask (see 
+           Variable.curdom), just the assigned value's bit if var is 
+           assigned'''
+        if var.assignedValue is None:
+            return var.curdom
+        return 1 << var.valIndex[var.assignedValue]
+
+    def domain_changed(self, var):
+        old = self.curdom[var.id]
+        new = self.live(var)
+        if old != new:
+            self.curdom[var.id] = new
+            removed = old & ~new
+            while removed:
+                low = removed & -removed
+                removed ^= low
+                self.value_changed(var, low.bit_length() - 1, 1)
+            added = new & ~old
+            while added:
+                low = added & -added
+                added ^= low
+                self.value_changed(var, low.bit_length() - 1, -1)
+        if self.listener is not None:
+            self.listener.domain_changed(var)
+
+    def value_changed(self, var, j, delta):
+        '''Internal routine. The j'th domain value of var was pruned 
+           (delta 1) or restored (delta -1)'''
+        count = self.count
+        for c, i in self.cons[var.id]:
+            table = c.sat_tuples
+            if j >= table.radix[i]:
+                continue    #a value added after the index was built, in no tuple
+            dead = self.dead[c]
+            s = table.base[i] + j
+            for r in table.supRows[table.supStart[s]:table.supStart[s + 1]]:
+                d = dead[r]
+                dead[r] = d + delta
+                if d == 0 or d + delta == 0:
+                    #row r became invalid (or valid again)
+                    for pair in zip(c.scope, table.row(r)):
+                        count[pair] -= delta
+
+class DegreeQueue:
+    '''Queue of the unassigned variables for the dom/wdeg and dom/ddeg
+       heuristics, with the same interface as MRVQueue. extract_min 
+       returns the variable minimizing 
+
+           current domain size / (weighted) degree
+
+       where the degree of V counts the constraints on V that have some 
+       other unassigned variable, each counted by its weight for dom/wdeg
+       (see Constraint.weight) or as one for dom/ddeg. Variables with
+       no such constraint come last. Ties are broken by position in the
+       list given on creation.
+
+       The scores change with every assignment and wipeout, so they are
+       computed when a variable is extracted, by a scan of the queued 
+       variables.'''
+
+    def __init__(self, vars, csp, weighted=True):
+        self.vars = list(vars)
+        self.index = dict()     #var --> position in self.vars
+        for i, v in enumerate(self.vars):
+            self.index[v] = i
+        self.cons = [csp.get_cons_with_var(v) for v in self.vars]
+        self.weighted = weighted
+        self.queued = [True] * len(self.vars)
+        self.size = len(self.vars)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, var):
+        self.queued[self.index[var]] = True
+        self.size += 1
+
+    def remove(self, var):
+        self.queued[self.index[var]] = False
+        self.size -= 1
+
+    def domain_changed(self, var):
+        pass
+
+    def extract_min(self):
+        '''Remove and return the variable with the smallest score (None 
+           if the queue is empty)'''
+        best = None
+        bestDom = 1
+        bestDeg = 0     #score of best is bestDom / bestDeg
+        weighted = self.weighted
+        for i, v in enumerate(self.vars):
+            if not self.queued[i]:
+                continue
+            deg = 0
+            for c in self.cons[i]:
+                for w in c.scope:
+                    if w is not v and w.assignedValue is None:
+                        deg += c.weight if weighted else 1
+                        break
+            dom = v.cur_domain_size()
+            if best is None or dom * bestDeg < bestDom * deg or (bestDeg == 0 and deg == 0 and dom < bestDom):
+                best = i
+                bestDom = dom
+                bestDeg = deg
+        if best is None:
+            return None
+        self.queued[best] = False
+        self.size -= 1
+        return self.vars[best]
+
+def luby(i):
+    '''Return the i'th term (i >= 1) of the Luby sequence 1, 1, 2, 1, 1,
+       2, 4, 1, 1, 2, 1, 1, 2, 4, 8, ...'''
+    while True:
+        k = i.bit_length()
+        if i == (1 << k) - 1:
+            return 1 << (k - 1)
+        i -= (1 << (k - 1)) - 1
+
+class ConflictSets:
+    '''Explanations of the domain reductions of a backjumping search.
+
+       The search numbers its decisions by depth 1, 2, ... and levels[V]
+       is a bitmask of the depths whose decisions imply V's current 
+       domain: just V's own depth if V is assigned, otherwise the union
+       of the explanations of V's pruned values (values pruned before the
+       first decision need no explanation). The masks are restored from
+       the trail on backtrack.
+
+       While a search installs it as csp.conflicts, propagators report
+       to it (see propagators.py):
+           pruned(c, V) -- c removed values of V: they are explained by
+                           the domains of the rest of c's scope.
+           failed(c)    -- c has a wiped out domain or an assigned value
+                           without support. The conflict set (the depths
+                           that together caused the failure) is left in
+                           self.conflict.
+       A propagator that fails without calling failed leaves conflict
+       None and the search falls back to chronological backtracking.
+
+       The explanations are per variable, not per value, so conflict
+       sets can be larger than necessary but are always sound.'''
+
+    def __init__(self, csp):
+        self.trail = csp.trail
+        self.levels = dict((v, 0) for v in csp.vars)
+        self.conflict = None
+
+    def assigned(self, var, depth):
+        '''var was assigned by the decision at depth (after the level
+           marker of that decision was pushed onto the trail)'''
+        self.trail.record(self, (var, self.levels[var]))
+        self.levels[var] = 1 << depth
+
+    def pruned(self, c, var):
+        levels = self.levels
+        mask = levels[var]
+        old = mask
+        for w in c.scope:
+            if w is not var:
+                mask |= levels[w]
+        if mask != old:
+            self.trail.record(self, (var, old))
+            levels[var] = mask
+
+    def failed(self, c):
+        levels = self.levels
+        mask = 0
+        for w in c.scope:
+            mask |= levels[w]
+        self.conflict = mask
+
+    def trail_undo(self, data):
+        var, mask = data
+        self.levels[var] = mask
+
+class NogoodStore:
+    '''Bounded store of nogoods learned by a backjumping search. A nogood
+       is a set of (Variable, value) decisions that cannot all be part of
+       a solution. Only nogoods of at most maxSize decisions are learned,
+       and once maxNogoods are stored the least recently used one is
+       evicted to make room.
+
+       A nogood is a list of its pairs, of which the first two are 
+       watched: it is only looked at when a watched pair is about to be
+       decided, and then one of its undecided (or contradicted) pairs
+       takes over the watch if there is one. Decisions are undone in
+       the reverse order they were made, so the watches never need to
+       move back on backtrack.'''
+
+    def __init__(self, maxNogoods, maxSize=None):
+        self.maxNogoods = maxNogoods
+        self.maxSize = maxSize
+        self.nogoods = collections.OrderedDict()    #id --> nogood, LRU first
+        self.watch = dict()     #(var, val) --> nogoods watching it
+        self.nLearned = 0
+        self.nHits = 0
+
+    def __len__(self):
+        return len(self.nogoods)
+
+    def learn(self, decisions):
+        '''Store the nogood made of the (var, val) pairs in decisions, 
+           which must be ordered by the depth they were decided at'''
+        if len(decisions) < 2 or (self.maxSize is not None and len(decisions) > self.maxSize):
+            return
+        if len(self.nogoods) >= self.maxNogoods:
+            #evicted nogoods are dropped from the watch lists lazily
+            self.nogoods.popitem(last=False)
+        #watch the two deepest decisions, they are the first undone
+        ng = decisions[::-1]
+        self.nogoods[id(ng)] = ng
+        self.watch.setdefault(ng[0], []).append(ng)
+        self.watch.setdefault(ng[1], []).append(ng)
+        self.nLearned += 1
+
+    def check(self, var, val, depthOf):
+        '''Return None if assigning val to var violates no stored nogood.
+           Otherwise return the conflict set of a violated nogood: the
+           bitmask of the depths (given by the dict depthOf) of its other
+           decisions, which are all currently made'''
+        pair = (var, val)
+        watching = self.watch.get(pair)
+        if not watching:
+            return None
+        nogoods = self.nogoods
+        keep = []
+        conflict = None
+        for k, ng in enumerate(watching):
+            if not id(ng) in nogoods:
+                continue
+            if ng[0] == pair:
+                ng[0], ng[1] = ng[1], ng[0]
+            for j in range(2, len(ng)):
+                other, otherVal = ng[j]
+                if other.assignedValue != otherVal:
+                    #move the watch
+                    ng[1], ng[j] = ng[j], ng[1]
+                    self.watch.setdefault(ng[1], []).append(ng)
+                    break
+            else:
+                keep.append(ng)
+                other, otherVal = ng[0]
+                if other.assignedValue == otherVal:
+                    #every other decision of ng is made
+                    self.nHits += 1
+                    nogoods.move_to_end(id(ng))
+                    conflict = 0
+                    for other, otherVal in ng:
+                        if other is not var:
+                            conflict |= 1 << depthOf[other]
+                    keep.extend(watching[k + 1:])
+                    break
+        self.watch[pair] = keep
+        return conflict
+
+class SearchMetrics:
+    '''Statistics of one search, returned by bt_search and bt_search_iter
+       and left in BT.metrics by every search (including bt_solutions).
+
+       csp, propagator  -- names of the CSP and the propagator function
+       status           -- True (solved), False (no solution) or None
+                           (bt_solutions, or the search was stopped)
+       runtime          -- CPU seconds
+       nodes            -- variable assignments made (BT.nDecisions)
+       failures         -- assignments whose propagation failed
+       backtracks       -- times a variable ran out of values
+       propagatorCalls  -- calls to the propagator, including the one
+                           at the root
+       prunings         -- values pruned
+       tupleChecks      -- tuples tested by has_support, and residueHits
+                           of these the calls answered by the residue
+       peakDepth        -- most decisions on the stack at once
+       peakTrail        -- most entries on the trail at once
+       restarts, backjumps, nogoods -- see BT.restarts_on, backjumping_on
+
+       With BT.metrics_on(timing=True) also
+       constraintChecks -- calls to the constraints' check method made
+                           by the propagators
+       propagatorTime   -- CPU seconds spent in the propagator
+       constraintTime   -- dict constraint name --> CPU seconds spent in
+                           its check and find_unsupported methods
+       (None otherwise).
+
+       as_dict/to_json export everything, csv_row one row of the scalar
+       fields (CSV_FIELDS) for write_csv.'''
+
+    CSV_FIELDS = ['csp', 'propagator', 'status', 'runtime', 'nodes',
+                  'failures', 'backtracks', 'propagatorCalls', 'prunings',
+                  'tupleChecks', 'residueHits', 'peakDepth', 'peakTrail',
+                  'restarts', 'backjumps', 'nogoods', 'constraintChecks',
+                  'propagatorTime']
+
+    def __init__(self, solver, propagator, status):
+        self.csp = solver.csp.name
+        self.propagator = getattr(propagator, '__name__', str(propagator))
+        self.status = status
+        self.runtime = solver.runtime
+        self.nodes = solver.nDecisions
+        self.failures = solver.nFailures
+        self.backtracks = solver.nBacktracks
+        self.propagatorCalls = solver.nPropagatorCalls
+        self.prunings = solver.nPrunings
+        self.tupleChecks, self.residueHits = solver.support_stats()
+        self.peakDepth = solver.peakDepth
+        self.peakTrail = solver.peakTrail
+        self.restarts = solver.nRestarts
+        self.backjumps = solver.nBackjumps
+        self.nogoods = 0
+        if solver.nogoods is not None:
+            self.nogoods = solver.nogoods.nLearned
+        self.constraintChecks = None
+        self.propagatorTime = None
+        self.constraintTime = None
+        timer = solver.timer
+        if timer is not None:
+            self.constraintChecks = timer.nChecks
+            self.propagatorTime = timer.propagatorTime
+            self.constraintTime = dict()
+            for c, secs in timer.constraintTime.items():
+                self.constraintTime[c.name] = self.constraintTime.get(c.name, 0) + secs
+
+    def as_dict(self):
+        d = dict((f, getattr(self, f)) for f in self.CSV_FIELDS)
+        d['constraintTime'] = self.constraintTime
+        return d
+
+    def to_json(self, **kwargs):
+        '''Return the metrics as a JSON object (kwargs go to json.dumps)'''
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def csv_row(self):
+        '''Return the scalar metrics as a list in CSV_FIELDS order'''
+        return [getattr(self, f) for f in self.CSV_FIELDS]
+
+    @staticmethod
+    def write_csv(metrics, f, header=True):
+        '''Write a list of SearchMetrics to the open file f as CSV, one 
+           row per search'''
+        writer = csv.writer(f)
+        if header:
+            writer.writerow(SearchMetrics.CSV_FIELDS)
+        for m in metrics:
+            writer.writerow(m.csv_row())
+
+    def __str__(self):
+        return self.to_json()
+
+class SearchTimer:
+    '''Timing instrumentation used by BT while metrics_on(timing=True).
+       wrap(propagator) returns the propagator timed. During a timed 
+       search the timer is installed as csp.timer and the propagators 
+       call the constraints' check and find_unsupported methods through
+       its check and find_unsupported. Without a timer they call them 
+       directly, so with timing off nothing is slowed down. Only the 
+       calls made by the propagators are counted and timed (e.g., the 
+       checks made by a has_support are part of the time of the 
+       find_unsupported they are made for).'''
+
+    def __init__(self, csp):
+        self.nChecks = 0
+        self.propagatorTime = 0
+        self.constraintTime = dict()    #constraint --> seconds
+        for c in csp.cons:
+            self.constraintTime[c] = 0
+
+    def wrap(self, propagator):
+        clock = time.process_time
+        def timed(csp, newVar=None):
+            start = clock()
+            try:
+                return propagator(csp, newVar)
+            finally:
+                self.propagatorTime += clock() - start
+        timed.__name__ = propagator.__name__
+        return timed
+
+    def check(self, c, vals):
+        '''Return c.check(vals), timed'''
+        self.nChecks += 1
+        start = time.process_time()
+        try:
+            return c.check(vals)
+        finally:
+            self.constraintTime[c] = (self.constraintTime.get(c, 0)
+                                      + time.process_time() - start)
+
+    def find_unsupported(self, c, changed=None):
+        '''Generate the pairs of c.find_unsupported(changed), the time 
+           taken to find each one timed'''
+        clock = time.process_time
+        gen = c.find_unsupported(changed)
+        while True:
+            start = clock()
+            try:
+                pair = next(gen)
+            except StopIteration:
+                return
+            finally:
+                self.constraintTime[c] = self.constraintTime.get(c, 0) + clock() - start
+            yield pair
+
 class BT:
     '''use a class to encapsulate things like statistics
        and bookeeping for pruning/unpruning variabel domains
@@ -380,9 +2162,36 @@ class BT:
         self.nDecisions = 0 #nDecisions is the number of variable 
                             #assignments made during search
         self.nPrunings  = 0 #nPrunings is the number of value prunings during search
-        unasgn_vars = list() #used to track unassigned variables
+        self.unasgn_vars = None #MRVQueue of unassigned variables during search
         self.TRACE = False
         self.runtime = 0
+        self.backjumping = False    #see backjumping_on
+        self.maxNogoods = 0
+        self.maxNogoodSize = None
+        self.nogoods = None     #NogoodStore of the current search
+        self.nBackjumps = 0     #decision levels skipped by backjumps
+        self.restartSchedule = None     #see restarts_on
+        self.restartCutoff = 0
+        self.restartFactor = 0
+        self.keepLearned = True
+        self.rng = None         #random tie-breaking while restarting
+        self.nRestarts = 0
+        self.varOrdering = 'mrv'    #see set_var_ordering
+        self.tieOrder = None        #see set_tie_order
+        self.valueOrdering = 'domain'   #see set_value_ordering
+        self.supportCounts = None   #SupportCounts of the lcv ordering
+        self.phase = dict()     #var --> value it was last assigned
+        self.nFailures = 0      #assignments whose propagation failed
+        self.nBacktracks = 0    #times a variable ran out of values
+        self.nPropagatorCalls = 0
+        self.peakDepth = 0      #most decisions on the stack at once
+        self.peakTrail = 0      #most entries on the trail at once
+        self.QUIET = False      #see quiet_on
+        self.timing = False     #see metrics_on
+        self.timer = None       #SearchTimer of the current search
+        self.metrics = None     #SearchMetrics of the last search
+        self.propagator = None  #propagator of the current search
+        self.searchPropagator = None    #the same, as passed in (untimed)
 
     def trace_on(self):
         '''Turn search trace on'''
@@ -392,16 +2201,192 @@ class BT:
         '''Turn search trace off'''
         self.TRACE = False
 
+    def quiet_on(self):
+        '''Do not print anything: bt_search and bt_search_iter just 
+           return their SearchMetrics (and leave the solution, if any, 
+           assigned to the variables)'''
+        self.QUIET = True
+
+    def quiet_off(self):
+        '''Print the outcome and statistics of bt_search (default)'''
+        self.QUIET = False
+
+    def metrics_on(self, timing=True):
+        '''Also collect the metrics that cost time to measure: CPU time
+           in the propagator and in each constraint, and the number of 
+           constraint checks (see SearchMetrics). The other metrics are
+           plain counters and are always collected.'''
+        self.timing = timing
+
+    def metrics_off(self):
+        '''Only collect the counters'''
+        self.timing = False
+
+    def backjumping_on(self, maxNogoods=1000, maxNogoodSize=None):
+        '''Search with conflict-directed backjumping: when every value of
+           a variable fails, jump back to the deepest decision in the 
+           union of the failures' conflict sets (see ConflictSets) 
+           instead of the previous one, skipping the decisions in between
+           that had nothing to do with the failures.
+
+           The conflict set of each exhausted variable is also learned
+           as a nogood (see NogoodStore): a later assignment that would
+           complete a stored nogood is refuted without propagating.
+           maxNogoods bounds the number kept (0 turns learning off) and
+           maxNogoodSize, if given, the number of decisions in one.
+
+           Backjumping is done by the non-recursive engine (bt_search
+           uses it too while backjumping is on) and relies on the 
+           propagator reporting its failures to csp.conflicts, as the
+           propagators in propagators.py do. A propagator that does not
+           simply gets chronological backtracking.'''
+        self.backjumping = True
+        self.maxNogoods = maxNogoods
+        self.maxNogoodSize = maxNogoodSize
+
+    def backjumping_off(self):
+        '''Go back to chronological backtracking'''
+        self.backjumping = False
+
+    def set_var_ordering(self, heuristic):
+        '''Choose how the search picks the next variable to assign:
+               'mrv'      -- smallest current domain (default, MRVQueue)
+               'dom/wdeg' -- smallest current domain divided by the 
+                             weighted degree: constraints that caused
+                             many wipeouts make their variables go first
+               'dom/ddeg' -- smallest current domain divided by the 
+                             number of constraints with other unassigned
+                             variables
+           (see DegreeQueue). The constraint weights start at one at the
+           start of each search.'''
+        if heuristic not in ('mrv', 'dom/wdeg', 'dom/ddeg'):
+            print("ERROR: unknown variable ordering", heuristic)
+            return
+        self.varOrdering = heuristic
+
+    def set_tie_order(self, order):
+        '''Break the ties of the variable ordering by the position of the
+           variables in order (a list of the CSP's variables) instead of
+           their order in the CSP. None goes back to the CSP's order. The
+           CSP's own variable list is never reordered (the variable ids
+           are positions in it).'''
+        if order is not None and sorted(v.id for v in order) != list(range(len(self.csp.vars))):
+            print("ERROR: tie order is not an ordering of the CSP's variables")
+            return
+        self.tieOrder = None if order is None else list(order)
+
+    def set_value_ordering(self, heuristic):
+        '''Choose the order in which the values of a variable are tried:
+               'domain' -- current domain order (default)
+               'lcv'    -- least constraining value first: the values 
+                           with the most valid supporting tuples first 
+                           (see SupportCounts; only the table constraints
+                           are counted)
+               'phase'  -- phase saving: the value the variable was last
+                           assigned (in this or an earlier search with
+                           this BT object) first, then domain order. So
+                           a solve of a slightly changed problem starts
+                           from the previous solution, and a restarted
+                           search from where the previous run got to.
+           Ties are broken by domain order, or randomly with restarts.'''
+        if heuristic not in ('domain', 'lcv', 'phase'):
+            print("ERROR: unknown value ordering", heuristic)
+            return
+        self.valueOrdering = heuristic
+        self.phase = dict()
+
+    def order_values(self, var, vals):
+        '''Internal routine. Sort the list vals of var's values into the
+           order they are to be tried in'''
+        if self.valueOrdering == 'lcv':
+            count = self.supportCounts.count
+            vals.sort(key=lambda val: -count.get((var, val), 0))
+        elif self.valueOrdering == 'phase':
+            saved = self.phase.get(var)
+            if saved is not None and vals[0] != saved and saved in vals:
+                vals.remove(saved)
+                vals.insert(0, saved)
+        return vals
+
+    def restarts_on(self, schedule='luby', cutoff=100, factor=1.5, seed=None,
+                    keepLearned=True):
+        '''Search for a solution by a sequence of runs, each abandoned 
+           (and the search restarted from the root) once it has made its
+           cutoff number of decisions. The i'th run (i = 1, 2, ...) may 
+           make
+               'luby'      -- cutoff * luby(i) decisions: 1, 1, 2, 1, 1,
+                              2, 4, 1, ... times cutoff
+               'geometric' -- cutoff * factor**(i-1) decisions
+           Every run breaks ties in the MRV variable choice and orders 
+           the values of each variable at random (seeded by seed), so a
+           run that gets stuck in a hopeless part of the tree is cut 
+           short and the next one starts somewhere else. The cutoffs 
+           grow without bound, so the search is still complete.
+
+           With keepLearned the nogoods learned by backjumping (see 
+           backjumping_on) and the constraint weights of the dom/wdeg 
+           heuristic (see set_var_ordering) are kept from run to run, 
+           otherwise every run starts from scratch.
+
+           Restarts apply to the searches for one solution (bt_search 
+           and bt_search_iter; bt_search uses bt_iterate while restarts
+           are on), not to bt_solutions.'''
+        if schedule not in ('luby', 'geometric'):
+            print("ERROR: unknown restart schedule", schedule)
+            return
+        self.restartSchedule = schedule
+        self.restartCutoff = cutoff
+        self.restartFactor = factor
+        self.keepLearned = keepLearned
+        self.rng = random.Random(seed)
+
+    def restarts_off(self):
+        '''Search without restarts'''
+        self.restartSchedule = None
+        self.rng = None
+
         
     def clear_stats(self):
         '''Initialize counters'''
         self.nDecisions = 0
         self.nPrunings = 0
         self.runtime = 0
+        self.nBackjumps = 0
+        self.nRestarts = 0
+        self.nFailures = 0
+        self.nBacktracks = 0
+        self.nPropagatorCalls = 0
+        self.peakDepth = 0
+        self.peakTrail = 0
+        for c in self.csp.cons:
+            c.clear_stats()
+
+    def support_stats(self):
+        '''Return (tuple checks, residue hits) made by has_support, 
+           summed over the constraints of the CSP'''
+        checks = 0
+        hits = 0
+        for c in self.csp.cons:
+            checks += c.nTupleChecks
+            hits += c.nResidueHits
+        return checks, hits
 
     def print_stats(self):
         print("Search made {} variable assignments and pruned {} variable values".format(
             self.nDecisions, self.nPrunings))
+        checks, hits = self.support_stats()
+        if checks:
+            print("Support search checked {} tuples ({} calls answered by residues)".format(
+                checks, hits))
+        if self.backjumping:
+            learned = refuted = 0
+            if self.nogoods is not None:
+                learned = self.nogoods.nLearned
+                refuted = self.nogoods.nHits
+            print("Backjumping skipped {} decision levels; {} nogoods learned, {} values refuted by them".format(
+                self.nBackjumps, learned, refuted))
+        if self.restartSchedule is not None:
+            print("Search restarted {} times".format(self.nRestarts))
 
     def restoreValues(self,prunings):
         '''Restore list of values to variable domains
@@ -410,40 +2395,59 @@ class BT:
             var.unprune_value(val)
 
     def restore_all_variable_domains(self):
-        '''Reinitialize all variable domains'''
+        '''Reinitialize all variable domains and the CSP's trail'''
+        self.csp.trail.clear()
         for var in self.csp.vars:
             if var.is_assigned():
                 var.unassign()
             var.restore_curdom()
+            var.trail = self.csp.trail
 
     def extractMRVvar(self):
-        '''Remove variable with minimum sized cur domain from list of
-           unassigned vars. Would be faster to use heap...but this is
-           not production code.
+        '''Remove variable with minimum sized cur domain from the 
+           queue of unassigned vars (a bucket queue, see MRVQueue)
         '''
-
-        md = -1
-        mv = None
-        for v in self.unasgn_vars:
-            if md < 0:
-                md = v.cur_domain_size()
-                mv = v
-            elif v.cur_domain_size() < md:
-                md = v.cur_domain_size()
-                mv = v
-        self.unasgn_vars.remove(mv)
-        return mv
+        return self.unasgn_vars.extract_min()
 
     def restoreUnasgnVar(self, var):
-        '''Add variable back to list of unassigned vars'''
-        self.unasgn_vars.append(var)
+        '''Add variable back to queue of unassigned vars'''
+        self.unasgn_vars.add(var)
+
+    def init_unasgn_vars(self, order=None):
+        '''Queue up the unassigned variables of the CSP and have their
+           domain changes reported to the queue. MRV ties are broken by
+           the position in order (default the order given to 
+           set_tie_order, else the CSP's variable list)'''
+        if order is None:
+            order = self.tieOrder if self.tieOrder is not None else self.csp.vars
+        vars = [v for v in order if not v.is_assigned()]
+        if self.varOrdering == 'mrv':
+            self.unasgn_vars = MRVQueue(vars)
+            listener = self.unasgn_vars
+        else:
+            self.unasgn_vars = DegreeQueue(vars, self.csp,
+                                           self.varOrdering == 'dom/wdeg')
+            listener = None     #scores are computed on extraction
+        self.supportCounts = None
+        if self.valueOrdering == 'lcv':
+            self.supportCounts = SupportCounts(self.csp, listener)
+            listener = self.supportCounts
+        for v in self.csp.vars:
+            v.listener = listener
+
+    def release_unasgn_vars(self):
+        '''Stop reporting domain changes to the queue'''
+        for v in self.csp.vars:
+            v.listener = None
+        self.unasgn_vars = None
+        self.supportCounts = None
         
     def bt_search(self,propagator):
         '''Try to solve the CSP using specified propagator routine
 
            propagator == a function with the following template
            propagator(csp, newly_instantiated_variable=None)
-           ==> returns (True/False, [(Variable, Value), (Variable, Value) ...]
+           ==> returns (True/False, [])
 
            csp is a CSP object---the propagator can use this to get access
            to the variables and constraints of the problem.
@@ -457,49 +2461,209 @@ class BT:
                in which case it must decide what processing to do
                prior to any variables being assigned.
 
-           The propagator returns True/False and a list of (Variable, Value) pairs.
+           The propagator returns True/False and a list (kept for
+           compatibility, propagators in this package return it empty).
            Return is False if a deadend has been detected by the propagator.
              in this case bt_search will backtrack
            return is true if we can continue.
 
-           The list of variable values pairs are all of the values
-           the propagator pruned (using the variable's prune_value method). 
-           bt_search NEEDS to know this in order to correctly restore these 
-           values when it undoes a variable assignment.
-
-           NOTE propagator SHOULD NOT prune a value that has already been 
-           pruned! Nor should it prune a value twice'''
-
+           The propagator prunes values using the variable's prune_value 
+           method, which records each pruning on the CSP's trail. bt_search
+           places a level marker on the trail before each assignment and 
+           pops back to it when it undoes the assignment, so every pruned 
+           value is restored exactly once.
+
+           With backjumping or restarts on (see backjumping_on and 
+           restarts_on) the search is done by bt_iterate.
+
+           Return the SearchMetrics of the search.'''
+
+        status, stime = self.start_search(propagator)
+        propagator = self.propagator
+        try:
+            if status:
+                if self.backjumping or self.restartSchedule is not None:
+                    status = self.bt_iterate(propagator)
+                else:
+                    status = self.bt_recurse(propagator, 1)   #now do recursive search
+        except BaseException:
+            #e.g., the propagator raised: leave no search state behind
+            self.end_search(stime)
+            self.unassign_all()
+            raise
+        self.finish_search(status, stime)
+        return self.metrics
+
+    def bt_search_iter(self, propagator):
+        '''Same as bt_search (same propagator contract, same result and
+           statistics) but the search is done by the loop in bt_iterate
+           with an explicit stack of choice points instead of recursion,
+           so the number of variables is not limited by python's 
+           recursion limit. Search trace is not supported.'''
+
+        status, stime = self.start_search(propagator)
+        try:
+            if status:
+                status = self.bt_iterate(self.propagator)
+        except BaseException:
+            self.end_search(stime)
+            self.unassign_all()
+            raise
+        self.finish_search(status, stime)
+        return self.metrics
+
+    def bt_solutions(self, propagator, vars=None, limit=None, as_dict=False,
+                     dedup=False, assumptions=None):
+        '''Generator over the solutions of the CSP, found lazily by the
+           same search as bt_search_iter. Nothing is printed.
+
+           Each solution is yielded as a tuple of the values of vars 
+           (default all the variables of the CSP, in CSP order), or if 
+           as_dict is True as a dict mapping each variable's name to its
+           value. 
+
+           limit   -- stop after this many solutions (default no limit)
+           dedup   -- only yield distinct tuples. Useful when vars is a
+                      subset of the variables, so that different solutions
+                      can give the same tuple. NOTE this keeps every tuple
+                      yielded so far; without it memory use does not grow
+                      with the number of solutions.
+
+           assumptions -- optional list of (Variable, value) decisions
+                      made (and propagated) before the search, so only
+                      the solutions extending them are generated.
+
+           The search state (domains, assignments, trail) is restored
+           when the generator finishes, including when the consumer
+           stops early (breaks out of the loop or closes the generator).
+           E.g., to check that a Tenner board has a unique solution:
+
+               len(list(solver.bt_solutions(prop_GAC, limit=2))) == 1
+           '''
+        if vars is None:
+            vars = self.csp.vars
+        vars = list(vars)
+        names = [v.name for v in vars]
+
+        status, stime = self.start_search(propagator, report=False,
+                                          assumptions=assumptions)
+        search = None
+        try:
+            if not status:
+                return
+            search = self.iter_search(self.propagator)
+            seen = set() if dedup else None
+            count = 0
+            for event in search:
+                soln = tuple([v.get_assigned_value() for v in vars])
+                if seen is not None:
+                    if soln in seen:
+                        continue
+                    seen.add(soln)
+                count += 1
+                if as_dict:
+                    yield dict(zip(names, soln))
+                else:
+                    yield soln
+                if limit is not None and count >= limit:
+                    return
+        finally:
+            if search is not None:
+                search.close()
+            self.end_search(stime)
+            self.unassign_all()
+
+    def unassign_all(self):
+        '''Unassign every assigned variable of the CSP'''
+        for v in self.csp.vars:
+            if v.is_assigned():
+                v.unassign()
+
+    def start_search(self, propagator, report=True, assumptions=None):
+        '''Internal routine. Reset statistics and domains, queue up the
+           unassigned variables and do the initial propagation, then make
+           and propagate the assumptions (a list of (Variable, value)
+           decisions), if any, each at its own trail level. Return
+           (status of the propagation, start time).
+
+           The propagator the search is to use (timed, if timing is on)
+           is left in self.propagator.'''
         self.clear_stats()
         stime = time.process_time()
+        self.searchPropagator = propagator
+        if self.timing:
+            self.timer = SearchTimer(self.csp)
+            self.csp.timer = self.timer
+            propagator = self.timer.wrap(propagator)
+        self.propagator = propagator
 
         self.restore_all_variable_domains()
+        for c in self.csp.cons:
+            c.weight = 1
         
-        self.unasgn_vars = []
-        for v in self.csp.vars:
-            if not v.is_assigned():
-                self.unasgn_vars.append(v)
-
-        status, prunings = propagator(self.csp) #initial propagate no assigned variables.
-        self.nPrunings = self.nPrunings + len(prunings)
-
-        if self.TRACE:
-            print(len(self.unasgn_vars), " unassigned variables at start of search")
-            print("Root Prunings: ", prunings)
-
-        if status == False:
-            print("CSP{} detected contradiction at root".format(
-                self.csp.name))
-        else:
-            status = self.bt_recurse(propagator, 1)   #now do recursive search
+        self.init_unasgn_vars()
+        self.nogoods = None
+        if self.backjumping and self.maxNogoods:
+            self.nogoods = NogoodStore(self.maxNogoods, self.maxNogoodSize)
+
+        trail = self.csp.trail
+        trail.push_level()
+        self.startPrunings = trail.nPrunings
+        try:
+            status, prunings = propagator(self.csp) #initial propagate no assigned variables.
+            self.nPropagatorCalls = 1
 
-
-        self.restoreValues(prunings)
+            if self.TRACE:
+                print(len(self.unasgn_vars), " unassigned variables at start of search")
+                print("Root Prunings: ", trail.nPrunings - self.startPrunings)
+
+            if status == False and report and not self.QUIET:
+                print("CSP{} detected contradiction at root".format(
+                    self.csp.name))
+
+            if assumptions:
+                for var, val in assumptions:
+                    if not status:
+                        break
+                    if var.is_assigned() or not var.in_cur_domain(val):
+                        status = False
+                        break
+                    self.unasgn_vars.remove(var)
+                    trail.push_level()
+                    var.assign(val)
+                    status, prunings = propagator(self.csp, var)
+                    self.nPropagatorCalls += 1
+        except BaseException:
+            #leave no search state (timer, listeners) behind
+            self.end_search(stime)
+            self.unassign_all()
+            raise
+        return status, stime
+
+    def end_search(self, stime, status=None):
+        '''Internal routine. Restore domains and record statistics in
+           self.metrics. Assignments are left in place.'''
+        trail = self.csp.trail
+        self.nPrunings = trail.nPrunings - self.startPrunings
+        self.nPropagatorCalls += self.nDecisions
+        trail.backtrack_to(0) #a solution leaves the decision levels in place
+        self.release_unasgn_vars()
+        self.runtime = time.process_time() - stime
+        self.csp.timer = None
+        self.metrics = SearchMetrics(self, self.searchPropagator, status)
+        self.timer = None
+
+    def finish_search(self, status, stime):
+        '''Internal routine. Restore domains, record statistics and
+           report the outcome of the search (unless quiet)'''
+        self.end_search(stime, status)
+        if self.QUIET:
+            return
         if status == False:
             print("CSP{} unsolved. Has no solutions".format(self.csp.name))
         if status == True:
             print("CSP {} solved. CPU Time used = {}".format(self.csp.name,
-                                                             time.process_time() - stime))
+                                                             self.runtime))
             self.csp.print_soln()
 
         print("bt_search finished")
@@ -520,30 +2684,380 @@ class BT:
             if self.TRACE:
                 print('  ' * level, "bt_recurse var = ", var)
 
-            for val in var.cur_domain():
+            trail = self.csp.trail
+            vals = var.cur_domain()
+            if self.valueOrdering != 'domain':
+                vals = self.order_values(var, vals)
+            for val in vals:
 
                 if self.TRACE:
                     print('  ' * level, "bt_recurse trying", var, "=", val)
 
+                trail.push_level()
+                nPruned = trail.nPrunings
                 var.assign(val)
                 self.nDecisions = self.nDecisions+1
 
                 status, prunings = propagator(self.csp, var)
-                self.nPrunings = self.nPrunings + len(prunings)
+                if trail.top > self.peakTrail:
+                    self.peakTrail = trail.top
 
                 if self.TRACE:
                     print('  ' * level, "bt_recurse prop status = ", status)
-                    print('  ' * level, "bt_recurse prop pruned = ", prunings)
+                    print('  ' * level, "bt_recurse prop pruned = ", trail.nPrunings - nPruned)
 
                 if status:
+                    self.phase[var] = val
+                    if level > self.peakDepth:
+                        self.peakDepth = level
                     if self.bt_recurse(propagator, level+1):
                         return True
+                else:
+                    self.nFailures += 1
 
                 if self.TRACE:
-                    print('  ' * level, "bt_recurse restoring ", prunings)
-                self.restoreValues(prunings)
+                    print('  ' * level, "bt_recurse restoring ", trail.nPrunings - nPruned)
+                trail.pop_level()
                 var.unassign()
 
             self.restoreUnasgnVar(var)
+            self.nBacktracks += 1
             return False
 
+    def bt_iterate(self, propagator):
+        '''Non-recursive version of bt_recurse. Return true if found
+           solution, False if there is none.'''
+        if self.restartSchedule is not None:
+            return self.restart_search(propagator)
+        for event in self.iter_search(propagator):
+            return True
+        return False
+
+    def restart_search(self, propagator):
+        '''Internal routine. bt_iterate with restarts, see restarts_on'''
+        trail = self.csp.trail
+        rootDepth = trail.depth()
+        run = 1
+        while True:
+            if self.restartSchedule == 'luby':
+                limit = self.restartCutoff * luby(run)
+            else:
+                limit = int(self.restartCutoff * self.restartFactor ** (run - 1))
+            order = list(self.csp.vars)
+            self.rng.shuffle(order)
+            self.init_unasgn_vars(order)
+
+            search = self.iter_search(propagator, nodeLimit=max(1, limit))
+            for event in search:
+                if event == 'solution':
+                    return True
+                break
+            else:
+                #the run finished its tree: there is no solution
+                return False
+
+            #abandon the run and go back to the root
+            search.close()
+            for var in self.searchStack[0]:
+                var.unassign()
+            trail.backtrack_to(rootDepth)
+            if not self.keepLearned:
+                if self.nogoods is not None:
+                    self.nogoods = NogoodStore(self.maxNogoods, self.maxNogoodSize)
+                for c in self.csp.cons:
+                    c.weight = 1
+            self.nRestarts += 1
+            run += 1
+
+    def iter_search(self, propagator, maxDepth=None, nodeLimit=None):
+        '''Internal routine. Generator doing the search of bt_iterate. 
+           It yields
+
+           'solution' -- each time all variables are assigned
+           'depth'    -- (only if maxDepth is given) instead of descending
+                         below maxDepth decisions. The node is treated
+                         as a leaf: its subtree is not searched.
+           'limit'    -- (only if nodeLimit is given) before descending 
+                         once nodeLimit more decisions have been made 
+                         since the start or the previous 'limit'. The 
+                         subtree of the current node is still unexplored.
+
+           Resuming it continues the search (after 'solution' and 'depth'
+           by retracting the deepest assignment).
+
+           The choice points are kept on three parallel stacks: the 
+           variable, the list of values to try for it and the position 
+           of the next one. The variables on the stack are the assigned
+           ones, each with a level marker on the trail. The stacks are
+           available as self.searchStack while the generator is paused,
+           see open_choice_points.
+
+           With backjumping on the search is done by cbj_search.'''
+
+        if self.backjumping:
+            yield from self.cbj_search(propagator, maxDepth, nodeLimit)
+            return
+
+        csp = self.csp
+        trail = csp.trail
+        push_level = trail.push_level
+        pop_level = trail.pop_level
+        unasgn = self.unasgn_vars
+        rng = self.rng
+        orderValues = None
+        if self.valueOrdering != 'domain':
+            orderValues = self.order_values
+        phase = self.phase
+        varStack = []
+        valStack = []
+        posStack = []
+        self.searchStack = (varStack, valStack, posStack)
+        nDecisions = self.nDecisions
+        nFailures = self.nFailures
+        nBacktracks = self.nBacktracks
+        peakDepth = self.peakDepth
+        peakTrail = self.peakTrail
+        nextLimit = None
+        if nodeLimit is not None:
+            nextLimit = nDecisions + nodeLimit
+        descend = True
+        try:
+            while True:
+                if descend:
+                    if not unasgn:
+                        #all variables assigned
+                        self.nDecisions = nDecisions
+                        yield 'solution'
+                        descend = False
+                        continue
+                    if maxDepth is not None and len(varStack) >= maxDepth:
+                        self.nDecisions = nDecisions
+                        yield 'depth'
+                        descend = False
+                        continue
+                    if nextLimit is not None and nDecisions >= nextLimit:
+                        self.nDecisions = nDecisions
+                        yield 'limit'
+                        nextLimit = nDecisions + nodeLimit
+                    var = unasgn.extract_min()
+                    vals = var.cur_domain()
+                    if rng is not None:
+                        rng.shuffle(vals)
+                    if orderValues is not None:
+                        vals = orderValues(var, vals)
+                    i = 0
+                else:
+                    #retract the deepest assignment, try its next value
+                    if not varStack:
+                        return
+                    var = varStack.pop()
+                    vals = valStack.pop()
+                    i = posStack.pop()
+                    pop_level()
+                    var.unassign()
+
+                descend = False
+                n = len(vals)
+                while i < n:
+                    push_level()
+                    var.assign(vals[i])
+                    i += 1
+                    nDecisions += 1
+                    status = propagator(csp, var)[0]
+                    if trail.top > peakTrail:
+                        peakTrail = trail.top
+                    if status:
+                        descend = True
+                        break
+                    nFailures += 1
+                    pop_level()
+                    var.unassign()
+
+                if descend:
+                    varStack.append(var)
+                    valStack.append(vals)
+                    posStack.append(i)
+                    phase[var] = vals[i - 1]
+                    if len(varStack) > peakDepth:
+                        peakDepth = len(varStack)
+                else:
+                    #all values tried, backtrack to the previous choice point
+                    unasgn.add(var)
+                    nBacktracks += 1
+        finally:
+            self.nDecisions = nDecisions
+            self.nFailures = nFailures
+            self.nBacktracks = nBacktracks
+            self.peakDepth = peakDepth
+            self.peakTrail = peakTrail
+
+    def cbj_search(self, propagator, maxDepth=None, nodeLimit=None):
+        '''Internal routine. iter_search with conflict-directed 
+           backjumping and nogood learning, same events.
+
+           Each choice point also keeps a conflict set: the bitmask of the
+           depths of the earlier decisions that caused its values to fail.
+           A value at depth d whose propagation fails adds the failure's
+           conflict set (from csp.conflicts, all depths if the propagator
+           did not report one) minus d. If the failure does not involve d
+           at all the remaining values would fail the same way, so the
+           variable is given up at once with that conflict set. When the
+           variable has no values left its conflict set, plus the 
+           explanation of the values pruned from its domain, is a nogood;
+           the search jumps back to its deepest decision, whose choice
+           point inherits the rest of it. An empty conflict set means the
+           search is over. After a solution (or maxDepth leaf) every 
+           depth is in the conflict set, so no solution is skipped.'''
+
+        csp = self.csp
+        trail = csp.trail
+        push_level = trail.push_level
+        pop_level = trail.pop_level
+        unasgn = self.unasgn_vars
+        rng = self.rng
+        orderValues = None
+        if self.valueOrdering != 'domain':
+            orderValues = self.order_values
+        phase = self.phase
+        conflicts = ConflictSets(csp)
+        levels = conflicts.levels
+        nogoods = self.nogoods
+        depthOf = dict()
+        varStack = []
+        valStack = []
+        posStack = []
+        confStack = []
+        self.searchStack = (varStack, valStack, posStack)
+        nDecisions = self.nDecisions
+        nFailures = self.nFailures
+        nBacktracks = self.nBacktracks
+        peakDepth = self.peakDepth
+        peakTrail = self.peakTrail
+        nextLimit = None
+        if nodeLimit is not None:
+            nextLimit = nDecisions + nodeLimit
+        descend = True
+        jump = 0
+        csp.conflicts = conflicts
+        try:
+            while True:
+                if descend:
+                    if not unasgn or (maxDepth is not None and len(varStack) >= maxDepth):
+                        self.nDecisions = nDecisions
+                        yield 'solution' if not unasgn else 'depth'
+                        #retract chronologically: every depth is involved
+                        jump = (1 << (len(varStack) + 1)) - 2
+                        descend = False
+                        continue
+                    if nextLimit is not None and nDecisions >= nextLimit:
+                        self.nDecisions = nDecisions
+                        yield 'limit'
+                        nextLimit = nDecisions + nodeLimit
+                    var = unasgn.extract_min()
+                    vals = var.cur_domain()
+                    if rng is not None:
+                        rng.shuffle(vals)
+                    if orderValues is not None:
+                        vals = orderValues(var, vals)
+                    i = 0
+                    conf = 0
+                    whyPruned = levels[var]
+                else:
+                    #jump back to the deepest decision of the conflict set,
+                    #undoing the ones above it, and try its next value
+                    if not jump:
+                        return
+                    target = jump.bit_length() - 1
+                    while True:
+                        var = varStack.pop()
+                        vals = valStack.pop()
+                        i = posStack.pop()
+                        conf = confStack.pop()
+                        pop_level()
+                        var.unassign()
+                        if len(varStack) < target:
+                            break
+                        unasgn.add(var)
+                        self.nBackjumps += 1
+                    conf |= jump ^ (1 << target)
+                    whyPruned = levels[var]
+
+                descend = False
+                depth = len(varStack) + 1
+                bit = 1 << depth
+                n = len(vals)
+                while i < n:
+                    val = vals[i]
+                    i += 1
+                    if nogoods is not None:
+                        mask = nogoods.check(var, val, depthOf)
+                        if mask is not None:
+                            conf |= mask
+                            continue
+                    push_level()
+                    var.assign(val)
+                    nDecisions += 1
+                    conflicts.assigned(var, depth)
+                    conflicts.conflict = None
+                    status = propagator(csp, var)[0]
+                    if trail.top > peakTrail:
+                        peakTrail = trail.top
+                    if status:
+                        descend = True
+                        break
+                    nFailures += 1
+                    pop_level()
+                    var.unassign()
+                    failure = conflicts.conflict
+                    if failure is None:
+                        failure = (bit << 1) - 2
+                    if not failure & bit:
+                        #var is not involved, its other values fail too
+                        conf = failure
+                        whyPruned = 0
+                        break
+                    conf |= failure ^ bit
+
+                if descend:
+                    varStack.append(var)
+                    valStack.append(vals)
+                    posStack.append(i)
+                    phase[var] = vals[i - 1]
+                    confStack.append(conf)
+                    depthOf[var] = depth
+                    if depth > peakDepth:
+                        peakDepth = depth
+                else:
+                    #var is exhausted: its values are refuted by the
+                    #decisions in conf, its pruned values by whyPruned
+                    unasgn.add(var)
+                    nBacktracks += 1
+                    jump = conf | whyPruned
+                    if nogoods is not None and jump:
+                        nogoods.learn([(varStack[d - 1], varStack[d - 1].assignedValue)
+                                       for d in range(1, depth) if (jump >> d) & 1])
+        finally:
+            self.nDecisions = nDecisions
+            self.nFailures = nFailures
+            self.nBacktracks = nBacktracks
+            self.peakDepth = peakDepth
+            self.peakTrail = peakTrail
+            csp.conflicts = None
+
+    def open_choice_points(self):
+        '''While iter_search is paused at a 'limit' event: return the
+           unexplored part of the search as a list of decision lists, 
+           each a list of (Variable, value) pairs starting from the root
+           (after any assumptions). Searching below each of these 
+           (e.g., as assumptions of another search) covers exactly the 
+           rest of the search space: the untried values of each choice
+           point on the stack, plus the subtree of the current node.'''
+        varStack, valStack, posStack = self.searchStack
+        prefix = []
+        points = []
+        for k, var in enumerate(varStack):
+            for val in valStack[k][posStack[k]:]:
+                points.append(prefix + [(var, val)])
+            prefix = prefix + [(var, var.get_assigned_value())]
+        points.append(prefix)
+        return points
@@ -0,0 +1,287 @@
+'''Parallel solving routines built on BT.
+
+   portfolio_solve runs several solver configurations on the same
+   problem in a multiprocessing pool and returns as soon as one of them
+   finishes. Which propagator is fastest on a given board can vary by
+   orders of magnitude, so racing them uses all the cores to cut the
+   latency of solving one hard instance.
+
+   parallel_solve splits ONE search tree across the pool (embarrassingly
+   parallel search): the top levels of the tree are enumerated into many
+   more subproblems than there are workers, each a list of decisions,
+   and the workers pick them up one at a time. A subproblem that runs
+   for long while other workers are idle is split further: the worker
+   stops and sends back the unexplored part of its search as new
+   subproblems. The statistics of all workers are added up.
+
+   The CSP is not sent to the workers: each worker builds its own copy
+   by calling factory(*args), so factory must be a module level function
+   (e.g., tenner_csp_model_1, whose args are (board,)). It may return
+   a CSP or a tuple whose first element is a CSP.
+
+   A configuration is a dict with keys
+      'propagator' -- 'BT', 'FC', 'GAC', 'CT' or a (module level)
+                      propagator function. Default 'GAC'.
+      'varOrdering' -- variable ordering heuristic, see 
+                      BT.set_var_ordering. Default 'mrv'.
+      'seed'       -- None (default) or an int. If given, the ties of 
+                      the variable ordering are broken by a shuffle of
+                      the CSP's variables made with this seed (see 
+                      BT.set_tie_order), so each configuration gets its
+                      own variable ordering.
+'''
+
+import multiprocessing
+import queue
+import random
+
+from cspbase import *
+from propagators import *
+
+PROPAGATORS = {'BT': prop_BT, 'FC': prop_FC, 'GAC': prop_GAC, 'CT': prop_CT}
+
+def build_csp(factory, args):
+    '''Call the factory and return the CSP it built'''
+    csp = factory(*args)
+    if isinstance(csp, tuple):
+        csp = csp[0]
+    return csp
+
+def configure(csp, config):
+    '''Apply a configuration to csp, return (solver, propagator)'''
+    propagator = config.get('propagator', 'GAC')
+    if not callable(propagator):
+        propagator = PROPAGATORS[propagator]
+    solver = BT(csp)
+    ordering = config.get('varOrdering')
+    if ordering is not None:
+        solver.set_var_ordering(ordering)
+    seed = config.get('seed')
+    if seed is not None:
+        #shuffle a copy: the variable ids are positions in csp.vars
+        order = list(csp.vars)
+        random.Random(seed).shuffle(order)
+        solver.set_tie_order(order)
+    return solver, propagator
+
+def solve_config(job):
+    '''Worker: solve the problem with one configuration. job is
+       (index, factory, args, config). Return (index, solution, stats)
+       where solution is a dict mapping variable names to values, or None
+       if the CSP has no solution'''
+    index, factory, args, config = job
+    csp = build_csp(factory, args)
+    solver, propagator = configure(csp, config)
+    solution = None
+    for solution in solver.bt_solutions(propagator, as_dict=True, limit=1):
+        pass
+    stats = {'nDecisions': solver.nDecisions, 'nPrunings': solver.nPrunings,
+             'runtime': solver.runtime}
+    return index, solution, stats
+
+def portfolio_solve(factory, args, configs, processes=None):
+    '''Race the configurations against each other on the CSP built by
+       factory(*args). Return (solution, config, stats) for the first
+       configuration to finish: solution is a dict mapping variable names
+       to values (None if that configuration proved there is no
+       solution), config is the winning configuration and stats its
+       search statistics. The other workers are terminated.
+
+       processes defaults to one per configuration, at most one per core.'''
+    if processes is None:
+        processes = min(len(configs), multiprocessing.cpu_count())
+    jobs = [(i, factory, args, config) for i, config in enumerate(configs)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        for index, solution, stats in pool.imap_unordered(solve_config, jobs):
+            return solution, configs[index], stats
+    finally:
+        pool.terminate()
+        pool.join()
+    return None, None, None
+
+def default_portfolio(n):
+    '''Return n configurations: the FC, GAC and CT propagators in turn,
+       the first of each with the model's own variable order and the
+       rest with seeds 1, 2, ... and alternately the mrv and dom/wdeg
+       variable orderings'''
+    configs = []
+    names = ['GAC', 'CT', 'FC']
+    orderings = ['mrv', 'dom/wdeg']
+    for i in range(n):
+        seed = None if i < len(names) else i
+        configs.append({'propagator': names[i % len(names)], 'seed': seed,
+                        'varOrdering': orderings[i // len(names) % len(orderings)]})
+    return configs
+
+#Shared by the pool of parallel_solve, set up by init_worker
+cancelEvent = None      #set by the master once a solution is found
+needWorkEvent = None    #set by the master while some worker is idle
+lastBuilt = None        #(factory, args, csp) of the last CSP built
+
+def init_worker(cancel, needWork):
+    global cancelEvent, needWorkEvent
+    cancelEvent = cancel
+    needWorkEvent = needWork
+
+def cached_csp(factory, args):
+    '''Return the CSP built by factory(*args), reusing the one built for
+       the previous subproblem when it is the same problem'''
+    global lastBuilt
+    if lastBuilt is None or lastBuilt[0] != factory or lastBuilt[1] != args:
+        lastBuilt = (factory, args, build_csp(factory, args))
+    return lastBuilt[2]
+
+def solve_subproblem(job):
+    '''Worker: search below the decisions of one subproblem. job is
+       (factory, args, propagator, decisions, count, nodeLimit) where
+       propagator is a name of PROPAGATORS or a (module level) propagator
+       function, sent to the worker as is, and decisions is a list of (variable name, value) pairs. Return a dict
+       with the solution found (None if none, or if count is True), the
+       number of solutions (if count is True, else 0 or 1), the split off
+       subproblems and the search statistics'''
+    factory, args, propagator, decisions, count, nodeLimit = job
+    csp = cached_csp(factory, args)
+    solver, propagator = configure(csp, {'propagator': propagator})
+    byName = dict((v.name, v) for v in csp.vars)
+    assumptions = [(byName[name], val) for name, val in decisions]
+
+    result = {'solution': None, 'count': 0, 'split': []}
+    if cancelEvent.is_set():
+        result['nDecisions'] = result['nPrunings'] = 0
+        return result
+
+    status, stime = solver.start_search(propagator, report=False,
+                                        assumptions=assumptions)
+    try:
+        if status:
+            search = solver.iter_search(propagator, nodeLimit=nodeLimit)
+            for event in search:
+                if cancelEvent.is_set():
+                    break
+                if event == 'solution':
+                    result['count'] += 1
+                    if not count:
+                        result['solution'] = dict((v.name, v.get_assigned_value())
+                                                  for v in csp.vars)
+                        break
+                elif event == 'limit' and needWorkEvent.is_set():
+                    #hand the rest of this subproblem back, split up
+                    for point in solver.open_choice_points():
+                        result['split'].append(
+                            decisions + [(v.name, val) for v, val in point])
+                    break
+            search.close()
+    finally:
+        solver.end_search(stime)
+        solver.unassign_all()
+    result['nDecisions'] = solver.nDecisions
+    result['nPrunings'] = solver.nPrunings
+    return result
+
+def decompose(solver, propagator, target):
+    '''Enumerate the nodes of the search tree at the smallest depth that
+       gives at least target of them (or the whole tree if it is small).
+       Return (subproblems, solutions): the decision lists (of (name,
+       value) pairs) of the nodes that survive propagation, and the
+       solutions found above that depth, as dicts'''
+    depth = 1
+    while True:
+        subproblems = []
+        solutions = []
+        status, stime = solver.start_search(propagator, report=False)
+        try:
+            if status:
+                for event in solver.iter_search(propagator, maxDepth=depth):
+                    varStack = solver.searchStack[0]
+                    if event == 'depth':
+                        subproblems.append([(v.name, v.get_assigned_value())
+                                            for v in varStack])
+                    elif event == 'solution':
+                        solutions.append(dict((v.name, v.get_assigned_value())
+                                              for v in solver.csp.vars))
+        finally:
+            solver.end_search(stime)
+            solver.unassign_all()
+        if len(subproblems) >= target or not subproblems:
+            return subproblems, solutions
+        depth += 1
+
+def parallel_solve(factory, args, propagator='GAC', processes=None, count=False,
+                   perWorker=30, nodeLimit=2000):
+    '''Solve the CSP built by factory(*args) by splitting its search tree
+       across a pool of processes. propagator is a name of PROPAGATORS or
+       a module level propagator function (it is pickled to the workers).
+
+       If count is False return (solution, stats) where solution is a dict
+       mapping variable names to values, or None if there is no solution.
+       As soon as one worker finds a solution the others are cancelled.
+       If count is True the whole tree is searched and the number of
+       solutions is returned in place of the solution.
+
+       perWorker  -- the top of the tree is split into at least this many
+                     subproblems per process
+       nodeLimit  -- a worker checks every nodeLimit decisions whether
+                     some worker is idle, and if so splits its subproblem
+
+       stats is a dict with the decisions and prunings summed over the
+       decomposition and all workers, and the number of subproblems
+       solved and of splits made.'''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    csp = build_csp(factory, args)
+    solver, prop = configure(csp, {'propagator': propagator})
+    subproblems, solutions = decompose(solver, prop, perWorker * processes)
+    stats = {'nDecisions': solver.nDecisions, 'nPrunings': solver.nPrunings,
+             'nSubproblems': 0, 'nSplits': 0}
+    if solutions and not count:
+        return solutions[0], stats
+    nSolutions = len(solutions)
+
+    cancel = multiprocessing.Event()
+    needWork = multiprocessing.Event()
+    results = queue.Queue()     #filled by the pool's result handler thread
+    pool = multiprocessing.Pool(processes, initializer=init_worker,
+                                initargs=(cancel, needWork))
+    outstanding = 0
+    solution = None
+    try:
+        for decisions in subproblems:
+            job = (factory, args, propagator, decisions, count, nodeLimit)
+            pool.apply_async(solve_subproblem, (job,), callback=results.put,
+                             error_callback=results.put)
+            outstanding += 1
+        if outstanding < processes:
+            needWork.set()
+        while outstanding:
+            result = results.get()
+            outstanding -= 1
+            if isinstance(result, BaseException):
+                raise result
+            stats['nSubproblems'] += 1
+            stats['nDecisions'] += result['nDecisions']
+            stats['nPrunings'] += result['nPrunings']
+            nSolutions += result['count']
+            if result['solution'] is not None:
+                solution = result['solution']
+                cancel.set()
+                break
+            if result['split']:
+                stats['nSplits'] += 1
+            for decisions in result['split']:
+                job = (factory, args, propagator, decisions, count, nodeLimit)
+                pool.apply_async(solve_subproblem, (job,), callback=results.put,
+                                 error_callback=results.put)
+                outstanding += 1
+            if outstanding < processes:
+                needWork.set()
+            else:
+                needWork.clear()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if count:
+        return nSolutions, stats
+    return solution, stats
@@ -6,7 +6,7 @@
 
    propagator == a function with the following template
       propagator(csp, newVar=None)
-           ==> returns (True/False, [(Variable, Value), (Variable, Value) ...]
+           ==> returns (True/False, [])
 
       csp is a CSP object---the propagator can use this to get access
       to the variables and constraints of the problem. The assigned variables
@@ -21,18 +21,17 @@
           in which case it must decide what processing to do
            prior to any variables being assigned. SEE BELOW
 
-       The propagator returns True/False and a list of (Variable, Value) pairs.
+       The propagator returns True/False and a list (kept for compatibility,
+       the propagators below always return it empty).
        Return is False if a deadend has been detected by the propagator.
        in this case bt_search will backtrack
        return is true if we can continue.
 
-      The list of variable values pairs are all of the values
-      the propagator pruned (using the variable's prune_value method). 
-      bt_search NEEDS to know this in order to correctly restore these 
-      values when it undoes a variable assignment.
-
-      NOTE propagator SHOULD NOT prune a value that has already been 
-      pruned! Nor should it prune a value twice
+      Values are pruned using the variable's prune_value method, which 
+      records the pruning on the CSP's trail. bt_search pops the trail back
+      to the level marker it placed before the assignment in order to 
+      restore these values, so propagators do not need to keep track of 
+      what they pruned (and pruning an already pruned value is harmless).
 
       PROPAGATOR called with newVar = None
       PROCESSING REQUIRED:
@@ -60,191 +59,459 @@
          for gac we initialize the GAC queue with all constraints containing V.
    '''
 
+from collections import deque
+import heapq
+
+from cspbase import Constraint
+
+#Order in which prop_GAC and prop_CT revise the queued constraints, see
+#set_queue_priority
+queuePriority = None
+
+def set_queue_priority(priority):
+  '''Choose the order in which prop_GAC and prop_CT revise the queued
+     constraints:
+         None   -- first in first out (default)
+         'cost' -- cheapest constraints first (see constraint_cost)
+         or a function mapping a constraint to a number, lower first
+     The setting is global to the module (use this function, a name
+     imported from the module is not updated)'''
+  global queuePriority
+  if priority == 'cost':
+    priority = constraint_cost
+  elif priority is not None and not callable(priority):
+    print("ERROR: unknown queue priority", priority)
+    return
+  queuePriority = priority
+
 def prop_BT(csp, newVar=None):
     '''Do plain backtracking propagation. That is, do no 
     propagation at all. Just check fully instantiated constraints'''
     
     if not newVar:
         return True, []
+    timer = csp.timer
     for c in csp.get_cons_with_var(newVar):
         if c.get_n_unasgn() == 0:
-            vals = []
-            vars = c.get_scope()
-            for var in vars:
-                vals.append(var.get_assigned_value())
-            if not c.check(vals):
+            vals = [var.assignedValue for var in c.scope]
+            if not (c.check(vals) if timer is None else timer.check(c, vals)):
+                c.weight += 1
+                if csp.conflicts is not None:
+                    csp.conflicts.failed(c)
                 return False, []
     return True, []
 
 def prop_FC(csp, newVar=None):
     '''Do forward checking. That is check constraints with 
-       only one uninstantiated variable. Remember to keep 
-       track of all pruned variable,value pairs and return '''
+       only one uninstantiated variable. Pruned values are recorded
+       on the CSP's trail'''
 #IMPLEMENT
-    
-    pruned_ls = []
 
     if not newVar:
       #we look for unary constraints of the csp (constraints whose scope 
       #contains only one variable) and we forward_check these constraints.
       for c in csp.get_all_cons():
-        scope = c.get_scope()
-        if len(scope) == 1 and c.get_n_unasgn() == 1: #and unassigned?
-          unasgn_vars = c.get_unasgn_vars();
-
-          DWOccurred, pruned_ls = FCCheck(c, unasgn_vars[0], pruned_ls)
+        if len(c.scope) == 1 and c.get_n_unasgn() == 1: #and unassigned?
+          if not FCCheck(c, c.scope[0], csp.conflicts, csp.timer):
+            return False, []
 
-          if not DWOccurred:
-            return False, pruned_ls      
-
-      return True, pruned_ls
+      return True, []
 
+    #the counters are kept by assign/unassign, so constraints that are
+    #not down to one unassigned variable are skipped in O(1)
     for c in csp.get_cons_with_var(newVar):
         if c.get_n_unasgn() == 1:
-            unasgn_vars = c.get_unasgn_vars();
-
-            DWOccurred, pruned_ls = FCCheck(c, unasgn_vars[0], pruned_ls)
-
-            if not DWOccurred:
-              return False, pruned_ls            
+            if not FCCheck(c, c.scope[c.get_last_unasgn()], csp.conflicts, csp.timer):
+              return False, []
 
-    return True, pruned_ls
+    return True, []
   
-def FCCheck(c, x, pruned_ls):
+def FCCheck(c, x, conflicts=None, timer=None):
   ''' C is a constraint with all its variables already assigned, except
-  for variable X'''
-  vals = []
-  vars = c.get_scope()
+  for variable X. Return False if X's domain is wiped out. The prunings
+  and the wipe out are reported to conflicts (csp.conflicts), if any.
+  The checks are made through timer (csp.timer), if any'''
+  vals = [var.assignedValue for var in c.scope]
+  unasgn_index = c.get_last_unasgn()
 
-  for var in vars:
-    vals.append(var.get_assigned_value())
-  
-  for index, val in enumerate(vals, start=0):
-    if val == None:
-      unasgn_index = index
-    
+  pruned = False
   for val in x.cur_domain():
     vals[unasgn_index] = val
-    if not c.check(vals):
+    if not (c.check(vals) if timer is None else timer.check(c, vals)):
       x.prune_value(val)
-      pruned_ls.append(tuple((x, val)))
-  
+      pruned = True
+
+  if pruned and conflicts is not None:
+    conflicts.pruned(c, x)
+
   if x.cur_domain_size() == 0:
-    return False, pruned_ls
+    c.weight += 1
+    if conflicts is not None:
+      conflicts.failed(c)
+    return False
   
-  return True, pruned_ls
+  return True
 
 
 def prop_GAC(csp, newVar=None):
     '''Do GAC propagation. If newVar is None we do initial GAC enforce 
        processing all constraints. Otherwise we do GAC enforce with
-       constraints containing newVar on GAC Queue'''
+       constraints containing newVar on GAC Queue. The queue is ordered
+       as set by set_queue_priority'''
 #IMPLEMENT
-    GACQueue = Queue()
-    pruned_ls = []
+    GACQueue = ArcQueue(queuePriority)
 
     if newVar == None:
         #for gac we establish initial GAC by initializing the GAC queue
-        #with all constaints of the csp
+        #with all constaints of the csp (None: revise the whole scope)
         for c in csp.get_all_cons():
-          GACQueue.enqueue(c)
-        DWOccurred, pruned_ls = GAC_Enforce(csp, GACQueue, pruned_ls)
+          GACQueue.enqueue((c, None))
 
-        if not DWOccurred:
-          return False, pruned_ls
-        
-        return True, pruned_ls
+        return GAC_Enforce(csp, GACQueue), []
 
-    #Prune all values of newVar that are not equal to its assigned value
-    for val in newVar.cur_domain():
-      if val != newVar.get_assigned_value():
-        pruned_ls.append(tuple((newVar, val)))
-        newVar.prune_value(val)
+    #The other values of newVar need no pruning: an assigned variable's
+    #current domain is its assigned value alone (see cur_domain, and the
+    #support tests). Reach the fixpoint once, starting from the arcs of
+    #newVar. On a deadend bt_search restores everything pruned here from
+    #the trail
+    for c in csp.get_cons_with_var(newVar):
+      GACQueue.enqueue((c, newVar))
 
-      for c in csp.get_cons_with_var(newVar):
-          GACQueue.enqueue(c)
+    return GAC_Enforce(csp, GACQueue), []
 
-      DWOccurred, pruned_ls = GAC_Enforce(csp, GACQueue, pruned_ls)
-      if not DWOccurred:
-        for p_val in newVar.domain():
-          if p_val not in newVar.cur_domain():
-            newVar.unprune_value(p_val)
 
-        return False, pruned_ls
+def GAC_Enforce(csp, q):
+  ''' GAC-Queue (an ArcQueue) contains arcs (C, V): constraint C has to
+  be revised because the domain of V, a variable in its scope, was
+  reduced. Only the other variables of scope(C) are revised (the values
+  of V keep their supports); V None means revise all of them. At the root of the search
+  tree first we run GAC_Enforce with (C, None) for all constraints.
+  Return False if a domain wipe out occurs'''
 
-    return True, pruned_ls
+  conflicts = csp.conflicts
+  timer = csp.timer
+  while not q.isEmpty():
+    c, changed = q.dequeue()
+    if timer is None:
+      unsupported = c.find_unsupported(changed)
+    else:
+      unsupported = timer.find_unsupported(c, changed)
+    for var, val in unsupported:
+      var.prune_value(val)
+      if conflicts is not None:
+        conflicts.pruned(c, var)
+
+      #When CurDom of variable is empty (an assigned variable whose
+      #value lost its support is a deadend too)
+      if var.is_assigned() or var.cur_domain_size() == 0:
+        c.weight += 1
+        if conflicts is not None:
+          conflicts.failed(c)
+        q.emptyQueue()
+        return False
+      else:
+        #push all arcs (C', var) st var is in scope(C') and (C', var)
+        #is not in GACQueue onto GACQueue
+        for con in csp.get_cons_with_var(var):
+          arc = (con, var)
+          if not q.accountedFor(arc):
+            q.enqueue(arc)
 
+  return True
 
-def GAC_Enforce(csp, q, pruned_ls):
-  ''' GAC-Queue contains all constraints one of whose variables has
-  had its domain reduced. At the root of the search tree
-  first we run GAC_Enforce with all constraints on GAC-Queue '''
 
-  while not q.isEmpty():
-    c = q.dequeue()
-    for var in c.get_scope():
-      for val in var.cur_domain():
 
-        if not c.has_support(var, val):
-          var.prune_value(val)
-          pruned_ls.append(tuple((var, val)))
+def prop_CT(csp, newVar=None):
+    '''Do GAC propagation using the Compact-Table algorithm for table
+       constraints (constraints of class Constraint). Drop in alternative
+       to prop_GAC: same arguments, same result, but each revision of a
+       table constraint filters all of its scope in one pass over a
+       bitset of the still valid tuples instead of scanning sup_tuples.
+       Other constraints are revised with find_unsupported as in 
+       GAC_Enforce. The queue is ordered as set by set_queue_priority'''
+    CTQueue = Queue(queuePriority)
+
+    if newVar == None:
+        #start from the full tables (state left over from an earlier
+        #search is stale), then establish initial GAC on all constraints
+        for c in csp.get_all_cons():
+          if type(c) is Constraint:
+            if c.ct is None:
+              c.ct = CompactTable(c)
+            c.ct.reset()
+          CTQueue.enqueue(c)
+    else:
+        for c in csp.get_cons_with_var(newVar):
+          CTQueue.enqueue(c)
+
+    return CT_Enforce(csp, CTQueue), []
 
-          #When CurDom of variable is empty
-          if var.cur_domain_size() == 0:
-            while not q.isEmpty():
-              q.dequeue() #Empty GACQueue
-            return False, pruned_ls
-          else:
-            #push all constraints C' st var is in scope(C') and C' is not in
-            #GACQueue onto GACQueue
-            for con in csp.get_cons_with_var(var):
-              if not q.accountedFor(con):
-                q.enqueue(con)
 
-  return True, pruned_ls
+def CT_Enforce(csp, q):
+  ''' Like GAC_Enforce, but table constraints are revised with their
+  CompactTable. Return False if a domain wipe out occurs'''
 
+  conflicts = csp.conflicts
+  timer = csp.timer
+  while not q.isEmpty():
+    c = q.dequeue()
+    if type(c) is Constraint:
+      if c.ct is None:
+        c.ct = CompactTable(c)
+      pruned = c.ct.revise(csp.trail)
+    elif timer is None:
+      pruned = list(c.find_unsupported())
+    else:
+      pruned = list(timer.find_unsupported(c))
+
+    if pruned is None:
+      c.weight += 1
+      if conflicts is not None:
+        conflicts.failed(c)
+      q.emptyQueue()
+      return False
+
+    for var, val in pruned:
+      #an assigned variable whose value lost its support is a deadend
+      if var.is_assigned():
+        c.weight += 1
+        if conflicts is not None:
+          conflicts.failed(c)
+        q.emptyQueue()
+        return False
+      var.prune_value(val)
+      if conflicts is not None:
+        conflicts.pruned(c, var)
+
+      if var.cur_domain_size() == 0:
+        c.weight += 1
+        if conflicts is not None:
+          conflicts.failed(c)
+        q.emptyQueue()
+        return False
+      for con in csp.get_cons_with_var(var):
+        if con is not c and not q.accountedFor(con):
+          q.enqueue(con)
+
+  return True
+
+
+class CompactTable:
+  '''Compact-Table filtering state for a table constraint.
+
+  The satisfying tuples are numbered 0..T-1 and the tuples still valid
+  (every value in its variable's current domain) are kept as a bitset
+  (a python int). For every scope position and value there is a
+  precomputed support mask: the bitset of tuples with that value at that
+  position. A value is supported iff its mask intersects the live tuples.
+
+  The live bitset and the domain sizes it was computed from are saved on
+  the CSP's trail (at most once per search level) so they are restored
+  on backtrack along with the variable domains.'''
+
+  def __init__(self, c):
+    self.scope = c.get_scope()
+    #the tuples are the rows of the table, the masks are read off its
+    #support index, so no tuple of values is ever built
+    table = c.get_supports()
+    n = len(table)
+    nbytes = (n + 7) // 8
+    start = table.supStart
+    supRows = table.supRows
+
+    #build the masks via bytearrays, OR-ing one bit at a time into a
+    #python int would be quadratic in the number of tuples
+    self.supports = [dict() for var in self.scope]
+    for i, dom in enumerate(table.domains):
+      for j, val in enumerate(dom):
+        s = table.base[i] + j
+        if start[s] == start[s + 1]:
+          continue
+        bits = bytearray(nbytes)
+        for r in supRows[start[s]:start[s + 1]]:
+          bits[r >> 3] |= 1 << (r & 7)
+        self.supports[i][val] = int.from_bytes(bits, 'little')
+
+    self.full = (1 << n) - 1
+    self.reset()
+
+  def reset(self):
+    '''Make every tuple live again'''
+    self.live = self.full
+    self.lastSize = [-1] * len(self.scope)
+    self.savedAt = None
+
+  def save(self, trail):
+    if self.savedAt != trail.stamp:
+      trail.record(self, (self.live, list(self.lastSize)))
+      self.savedAt = trail.stamp
+
+  def trail_undo(self, data):
+    self.live, self.lastSize = data
+    self.savedAt = None
+
+  def revise(self, trail):
+    '''Remove the tuples invalidated by domain changes since the last
+    revision, then return the list of (var, val) pairs that have lost all
+    their supports. Return None if no tuple is left.'''
+    live = self.live
+    sizes = []
+    for i, var in enumerate(self.scope):
+      size = var.cur_domain_size()
+      sizes.append(size)
+      #within a branch domains only shrink, so an unchanged size
+      #means an unchanged domain
+      if size != self.lastSize[i]:
+        sup = self.supports[i]
+        mask = 0
+        for val in var.cur_domain():
+          mask |= sup.get(val, 0)
+        live &= mask
+
+    if live == 0:
+      return None
+
+    pruned = []
+    for i, var in enumerate(self.scope):
+      sup = self.supports[i]
+      for val in var.cur_domain():
+        if not sup.get(val, 0) & live:
+          pruned.append((var, val))
+          sizes[i] -= 1
+
+    if live != self.live or sizes != self.lastSize:
+      self.save(trail)
+      self.live = live
+      self.lastSize = sizes
+    return pruned
 
 
 class Queue:
-  def __init__(self):
-    self.items = []
+  '''Work queue of the GAC propagators. Items are kept at most once
+     (accountedFor is a set lookup), so every operation is O(1), or
+     O(log n) when a priority is given.
+
+     priority -- None (default) for a FIFO queue, or a function mapping
+                 an item to a number: items with lower numbers are
+                 dequeued first, ties in FIFO order. See constraint_cost'''
+  def __init__(self, priority=None):
+    self.priority = priority
+    self.items = deque() if priority is None else []   #heap if priority
+    self.members = set()
+    self.count = 0    #enqueue counter, breaks ties of the heap FIFO
+    #heap entries are (0, 0, -count, item) for the items put in front,
+    #(1, priority, count, item) for the others: the leading flag keeps
+    #the priorities (of any type) from being compared with the front's
 
   def isEmpty(self):
     #Check if queue is empty
-    return self.items == []
-  
+    return not self.items
+
   def enqueue(self, item):
     #Adds item to end of queue
-    rear = len(self.items) + 1
-    self.items.insert(rear, item)
-  
+    self.members.add(item)
+    if self.priority is None:
+      self.items.append(item)
+    else:
+      self.count += 1
+      heapq.heappush(self.items, (1, self.priority(item), self.count, item))
+
   def dequeue(self):
     #Removes 1st item in the list
     if self.isEmpty():
       print("ERROR: Queue is empty")
+      return None
+    if self.priority is None:
+      item = self.items.popleft()
     else:
-      return self.items.pop(0)  
+      item = heapq.heappop(self.items)[3]
+    self.members.discard(item)
+    return item
 
   def insert_front(self, item):
     #Adds item to start of queue
-    self.items.insert(0, item)
+    self.members.add(item)
+    if self.priority is None:
+      self.items.appendleft(item)
+    else:
+      self.count += 1
+      heapq.heappush(self.items, (0, 0, -self.count, item))
 
   def size(self):
     #Returns size of queue
     return len(self.items)
-  
+
   def printqueue(self):
-      print(self.items)
-  
+      print(self.getQueue())
+
   def getQueue(self):
     #returns list representing queue
-    return self.items
+    if self.priority is None:
+      return list(self.items)
+    return [entry[3] for entry in sorted(self.items)]
 
   def emptyQueue(self):
     #delete all items in queue
-    while not self.isEmpty():
-      self.dequeue()
-    
+    self.items.clear()
+    self.members.clear()
+
   def accountedFor(self, item):
     #check if item is in queue
-    return item in self.items
+    return item in self.members
+
+
+class ArcQueue(Queue):
+  '''Queue of arcs (C, V) for GAC_Enforce. Arcs of the same constraint
+     are merged, so C is queued at most once: (C, V) then (C, W) gives
+     (C, None), i.e., revise all of scope(C), and dequeue returns the
+     merged arc. priority, if given, is applied to the constraint'''
+  def __init__(self, priority=None):
+    Queue.__init__(self, priority)
+    self.changed = dict()   #queued constraint --> its changed var or None
+
+  def enqueue(self, arc):
+    c, var = arc
+    if c in self.changed:
+      if self.changed[c] is not var:
+        self.changed[c] = None
+    else:
+      self.changed[c] = var
+      Queue.enqueue(self, c)
+
+  def dequeue(self):
+    c = Queue.dequeue(self)
+    if c is None:
+      return None
+    return c, self.changed.pop(c)
+
+  def insert_front(self, arc):
+    c, var = arc
+    if c in self.changed:
+      self.enqueue(arc)
+    else:
+      self.changed[c] = var
+      Queue.insert_front(self, c)
+
+  def getQueue(self):
+    return [(c, self.changed[c]) for c in Queue.getQueue(self)]
+
+  def emptyQueue(self):
+    Queue.emptyQueue(self)
+    self.changed.clear()
+
+  def accountedFor(self, arc):
+    #check if the revision arc asks for is already queued
+    c, var = arc
+    if not c in self.changed:
+      return False
+    queued = self.changed[c]
+    return queued is None or queued is var
+
+
+def constraint_cost(c):
+  '''Priority for Queue: revise the cheapest constraints first, those of
+     smallest arity and, among them, of smallest revision cost (see
+     Constraint.revision_cost: the number of tuples of a table, an 
+     estimate of the filtering work for the other kinds). They tend to
+     prune or fail soonest'''
+  return (len(c.get_scope()), c.revision_cost())
@@ -153,18 +153,10 @@ def tenner_csp_model_1(initial_tenner_board):
           #If value is pre-assigned, subtract this value from desired
           desired -= n_grid_T[col][row]
 
-      varDoms = []
-      for var in opt:
-        varDoms.append(var.domain())
-
-      #Find satisfying tuples and add to constraint list
-      sat_tuples = []
-      for t in itertools.product(*varDoms):
-        if sum(t) == desired:  #Require unknown values to equal desired sum
-          sat_tuples.append(t)
-
-      con = Constraint('C:Sum_Col{}'.format(col), opt)
-      con.add_satisfying_tuples(sat_tuples)
+      #Require unknown values to equal desired sum. The sum is a native 
+      #linear constraint (exact filtering), no tuples are enumerated.
+      con = LinearSumConstraint('C:Sum_Col{}'.format(col), opt, [1] * len(opt),
+                                desired, domain_consistent=True)
       tenner_csp.add_constraint(con)
 
 
@@ -248,23 +240,10 @@ def tenner_csp_model_2(initial_tenner_board):
     
     #ALL DIFFERENT ROW CONSTRAINT
     for row in range(len(n_grid)):
-      opt = []
-      varDoms = list(dom)
-      for col in range(len(n_grid_T)):
-        if n_grid[row][col] == -1:
-          opt.append(variable_array[row][col])
-        else:
-          #Remove pre-assigned values from the domain to be considered
-          if n_grid[row][col] in varDoms:
-            varDoms.remove(n_grid[row][col])
-
-      #Find satisfying tuples and add to constraint list
-      sat_tuples = []
-      for t in itertools.permutations(varDoms, len(opt)):
-          sat_tuples.append(t)
-
-      con = Constraint('C:Row{}'.format(col), opt)
-      con.add_satisfying_tuples(sat_tuples)
+      #The whole row is in the scope: pre-assigned cells have a single
+      #value in their domain, so the matching keeps those values away 
+      #from the free cells. No tuples are built.
+      con = AllDiffConstraint('C:Row{}'.format(row), variable_array[row])
       tenner_csp.add_constraint(con)  
     
       #CONTIGUOUS CONSTRAINTS - COL AND DIAGONAL
@@ -318,18 +297,10 @@ def tenner_csp_model_2(initial_tenner_board):
           #If value is pre-assigned, subtract this value from desired
           desired -= n_grid_T[col][row]
 
-      varDoms = []
-      for var in opt:
-        varDoms.append(var.domain())
-
-      #Find satisfying tuples and add to constraint list
-      sat_tuples = []
-      for t in itertools.product(*varDoms):
-        if sum(t) == desired:  #Require unknown values to equal desired sum
-          sat_tuples.append(t)
-
-      con = Constraint('C:Sum_Col{}'.format(col), opt)
-      con.add_satisfying_tuples(sat_tuples)
+      #Require unknown values to equal desired sum. The sum is a native 
+      #linear constraint (exact filtering), no tuples are enumerated.
+      con = LinearSumConstraint('C:Sum_Col{}'.format(col), opt, [1] * len(opt),
+                                desired, domain_consistent=True)
       tenner_csp.add_constraint(con)
 
     return tenner_csp, variable_array
@@ -338,17 +309,8 @@ def add_constraints_binary(combos, csp):
     '''This function adds constraints from the given pair passed in through the 
     argument combo and adds the constraint to the given csp
     '''
-    con = Constraint('C:V{}xV{}'.format(combos[0].name, combos[1].name), combos)
-
-    varDoms = []
-    for var in combos:
-      varDoms.append(var.domain())
-
-    #Find satisfying tuples and add to constraint list
-    sat_tuples = []
-    for t in itertools.product(*varDoms):
-      if t[0] != t[1]:  #Tuple can not represent the same value twice!
-        sat_tuples.append(t)
-
-    con.add_satisfying_tuples(sat_tuples)
-    csp.add_constraint(con)
\ No newline at end of file
+    #The not-equal table over the two domains is built once and shared by
+    #every constraint (and board) over the same domains.
+    con = table_constraint('C:V{}xV{}'.format(combos[0].name, combos[1].name),
+                           combos, 'neq')
+    csp.add_constraint(con)